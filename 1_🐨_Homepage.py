@@ -3,28 +3,37 @@ Homepage.py
     This is the main landing page of the Treemaker Web App.
     It accepts the tree file from the user and the parser
     dataframe.
-    This file passes the files to tree-render-functions.py
-    which is run to generate the tree ans presents the 
-    saved png.
+    This file passes the tree and the settings to the render
+    engine, which is run in the render pool to generate the
+    tree, and presents the svg it returns.
     It then offers the user a choice to download the generated tree
     file.
     For more information see:
     https://github.com/walkerazam/cohn-treemaker
 """
 import streamlit as st
-import subprocess
-import sys
-import os
-import glob
+import json
+import hashlib
+import time
+from io import StringIO
 import pandas as pd
 import numpy as np
+import altair as alt
 from datetime import datetime
 
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-from ete3 import Tree, TreeStyle, PhyloTree, TextFace, NodeStyle, SeqMotifFace
-# from ete3 import faces, AttrFace, CircleFace, TextFace, RectFace
+from newick_reader import TREE_EXTENSIONS, COMPRESSED_EXTENSIONS
+from alignment_clones import ALIGNMENT_EXTENSIONS
+from clone_detection import clone_groups_at, stacked_node_curve
+from tree_export import EXPORT_FORMATS, EXPORT_DPI
+from svg_render import restyle_svg, parser_styles
+from clade_detail import DETAIL_LEAVES
+from render_engine import RenderSettings, render, render_clade, search_clones, search_alignment_clones, \
+    search_clone_groups, search_clone_distances
+from render_pool import RenderPool, RenderQueueFull, RenderJobStopped
+from svg_tiles import SvgTiles, WHOLE_TREE_ELEMENTS, VIEW_WIDTH, VIEW_HEIGHT
 
 st.set_page_config(page_title="Homepage", page_icon="🐨")
 
@@ -72,25 +81,209 @@ with st.expander("🌿 Click to see Koalafy's workflow"):
 
 st.markdown("For more detailed instructions and examples, please reference the `About` page.")
 
-# Upon start, search for uploaded_tree.tre in current dir, or tree-file.png/pdf in data/ and clear
-def clear_files():
+@st.cache_data(show_spinner="Searching tree for clones...")
+def analyse_clones(tree_bytes, rooting_node, thresholds, _parallel=False):
     """
-    When this function is called, uploaded_tree.tre temp file is cleared from directory and
-    any existing png/pdf/svg files in the data directory are also cleared
+    This function roots the uploaded tree, searches it for clones at
+    every threshold of the slider in one go, in the render pool. The
+    result is cached, so moving the
+    slider or editing the parser table does not repeat it. With
+    _parallel, large trees are searched on the CPUs available (the
+    result is the same, so it is not part of the cache key).
     """
-    pdf_files = glob.glob(os.path.join('./data/', '**', '*.pdf'), recursive=True)
-    for file in pdf_files:
-        os.remove(file)
-    png_files = glob.glob(os.path.join('./data/', '**', '*.png'), recursive=True)
-    for file in png_files:
-        os.remove(file)
-    svg_files = glob.glob(os.path.join('./data/', '**', '*.svg'), recursive=True)
-    for file in svg_files:
-        os.remove(file)
-    if os.path.isfile('uploaded_tree.tre'):
-        os.remove('uploaded_tree.tre')
-
-clear_files()
+    return render_pool().run(search_clones, tree_bytes, rooting_node, thresholds, _parallel)
+
+@st.cache_data(show_spinner="Searching tree for clones...")
+def clone_groups(tree_bytes, rooting_node, thresholds, threshold):
+    """
+    This function returns the clone membership (the leading leaf of
+    every leaf) for one tree, rooting and threshold. It does not depend
+    on the parser tables, so editing them only re-annotates the leaves.
+    Thresholds outside of the slider are searched directly.
+    """
+    clone_table = analyse_clones(tree_bytes, rooting_node, thresholds)
+    leader_of = clone_groups_at(clone_table, threshold)
+    if leader_of is None:
+        leader_of = render_pool().run(search_clone_groups, tree_bytes, rooting_node, threshold)
+    return pd.DataFrame({"leaf": clone_table["leaf"], "leader": leader_of})
+
+@st.cache_data(show_spinner="Comparing aligned sequences...")
+def analyse_alignment_clones(tree_bytes, rooting_node, alignment_bytes, thresholds):
+    """
+    This function searches the uploaded alignment for clones at every
+    mismatch threshold of the slider in one go, in the render pool. The
+    result is cached like analyse_clones().
+    """
+    return render_pool().run(search_alignment_clones, tree_bytes, rooting_node, alignment_bytes, thresholds)
+
+@st.cache_data(show_spinner=False)
+def clone_distances(tree_bytes, rooting_node, clones):
+    """
+    This function returns the within-clone and nearest neighbour
+    distances of every stacked node for the chosen clones. They are
+    measured in the render pool, where the distance index of the tree
+    is built and left.
+    """
+    return render_pool().run(search_clone_distances, tree_bytes, rooting_node,
+                             clones["leaf"].to_list(), clones["leader"].to_numpy())
+
+def drawn_styles(parser_df, unmapped):
+    """
+    This function returns the colors (of every SeqType in the legend) and
+    shapes that the parser table draws.
+    """
+    seqtype_cmap, shapes = parser_styles(parser_df, unmapped)
+    return list(seqtype_cmap.values()), shapes
+
+def restyle_rendered_tree(render_key, parser_df):
+    """
+    This function updates the tree drawn last if only the colors or
+    shapes of the parser table changed since (render_key, of everything
+    else the drawing depends on, is the same). The glyphs are restyled in
+    place, so the tree is not drawn again. Trees drawn by ete3 are kept
+    if nothing changed. It returns False if the tree has to be drawn.
+    """
+    rendered = st.session_state.get("rendered_tree")
+    if rendered is None or rendered["key"] != render_key:
+        return False
+    if rendered["style"] is None:
+        return rendered["parser"].equals(parser_df)
+    try:
+        styles = drawn_styles(parser_df, rendered["style"]["unmapped"])
+        svg = restyle_svg(rendered["svg"], rendered["style"]["glyphs"], styles, rendered["styles"])
+    except (KeyError, ValueError):
+        return False  # drawing the tree reports the problem
+    rendered.update(svg=svg, styles=styles, parser=parser_df)
+    return True
+
+def keep_rendered_tree(render_key, parser_df, result):
+    """
+    This function keeps the tree just drawn by the render engine and its
+    style map in the session, so it can be restyled (trees drawn by ete3
+    have none). The analysis of the tree is kept too, so its clades can
+    be drawn on their own. Nothing is kept if the tree was not drawn.
+    """
+    st.session_state.pop("rendered_tree", None)
+    st.session_state.pop("tree_analysis", None)
+    if result is None:
+        return
+    st.session_state["tree_analysis"] = result["analysis"]
+    style = result["style"]
+    st.session_state["rendered_tree"] = {
+        "key": render_key, "svg": result["svg"], "style": style, "parser": parser_df,
+        "styles": drawn_styles(parser_df, style["unmapped"]) if style is not None else None}
+
+@st.cache_resource
+def render_pool():
+    """
+    This function returns the pool of warm render workers, shared by
+    every session of the app.
+    """
+    return RenderPool()
+
+def job_error(error):
+    """
+    This function returns the message shown for the error of a job of the
+    render pool.
+    """
+    if isinstance(error, RenderQueueFull):
+        return "The server is busy with other trees, please try again in a few minutes."
+    if isinstance(error, RenderJobStopped):
+        return f"It was stopped, as {error}."
+    return f"{type(error).__name__}: {error}"
+
+def render_with_preview(render_key, *args):
+    """
+    This function draws the tree with render_engine.render() and args in
+    the render pool, and returns its results, or None if it could not be
+    drawn (the error is shown). Until it is done, its place in line or the
+    stage it is at is shown, with the preview it draws before the tree and
+    a button to cancel it. Jobs left behind by a rerun of the page are
+    cancelled, so they do not hold up the workers.
+    """
+    try:
+        job = render_pool().start(render, *args)
+    except RenderQueueFull as e:
+        st.error(f"Error in creating tree. {job_error(e)}")
+        return None
+    cancel = st.empty()
+    cancel.button("Cancel drawing", on_click=cancel_render, args=(render_key,))
+    placeholder = st.empty()
+    shown = None
+    try:
+        while not job.poll(1.0):
+            # the page is updated about every second, which is also where
+            # Streamlit stops this run when the page is rerun
+            position = job.position()
+            if position is not None:
+                status = (f"Waiting for a free worker, {position} tree(s) ahead in line..." if position
+                          else "Waiting for a free worker, next in line...")
+            else:
+                status = f"{job.stage or 'Starting...'} ({time.monotonic() - job.started:.0f} s)"
+            preview = job.results.get("preview")
+            if (status, preview is not None) != shown:
+                with placeholder.container():
+                    st.caption(status)
+                    if preview is not None:
+                        st.header("Tree Visualization")
+                        st.caption("Preview with fewer leaves, the full tree is still being drawn...")
+                        st.image(preview, width=10000)
+                shown = (status, preview is not None)
+    finally:
+        job.cancel()  # only if it is not done
+    cancel.empty()
+    placeholder.empty()
+    try:
+        return job.result()
+    except Exception as e:
+        st.error(f"Error in creating tree. {job_error(e)}")
+        return None
+
+def cancel_render(render_key):
+    """
+    This function is called by the cancel button of a tree being drawn.
+    The page is rerun, which stops the job, and the tree is not drawn again
+    until asked for.
+    """
+    st.session_state["cancelled_render"] = render_key
+
+@st.cache_data(show_spinner="Preparing the tree view...", max_entries=4)
+def svg_tiles(svg):
+    """
+    This function returns the tiles of an SVG drawn by svg_render, or None
+    for SVGs drawn by ete3. They are cached, so moving around the tree
+    only opens the tiles in view.
+    """
+    try:
+        return SvgTiles.from_svg(svg)
+    except ValueError:
+        return None
+
+def show_svg(svg, key):
+    """
+    This function shows an SVG. SVGs drawn by svg_render are shown a view
+    at a time, with zoom and position sliders, so only the part of the
+    tree in view is sent to the browser and drawn there.
+    """
+    tiles = svg_tiles(svg)
+    if tiles is None:
+        st.image(svg, width=10000)
+        return
+    zoom = st.select_slider("Zoom", options=["Whole tree", 0.125, 0.25, 0.5, 1, 2, 4], key=f"{key}_zoom",
+                            value="Whole tree" if tiles.elements <= WHOLE_TREE_ELEMENTS else 1,
+                            format_func=lambda zoom: zoom if zoom == "Whole tree" else f"{zoom:g}x",
+                            help="At 1x, the tree is shown at the size it is drawn")
+    x, y, width, height = tiles.left, tiles.top, tiles.width, tiles.height
+    if zoom != "Whole tree":
+        width = min(VIEW_WIDTH / zoom, tiles.width)
+        height = min(VIEW_HEIGHT / zoom, tiles.height)
+        if width < tiles.width:
+            across = st.slider("Across the tree (%)", 0.0, 100.0, 0.0, step=0.1, key=f"{key}_across")
+            x += (tiles.width - width) * across / 100
+        if height < tiles.height:
+            down = st.slider("Down the tree (%)", 0.0, 100.0, 0.0, step=0.1, key=f"{key}_down")
+            y += (tiles.height - height) * down / 100
+    st.image(tiles.view(x, y, width, height), width=10000)
 
 st.header("Sequence Parser")
 tab1, tab2 = st.tabs(["Online Input", "CSV Upload"])
@@ -157,6 +350,13 @@ with tab2:
         if edited_df.isnull().any().any():  # check again for any human edits
                     st.error("Missing values detected. Parser table should not contain any missing values.")
 
+# trees written with [&&NHX:SeqType=...:Class=...] tags can skip the parser strings
+nhx_on = st.toggle("Annotate from NHX tags")
+if nhx_on:
+    st.caption("SeqType and Classification are read from the SeqType and Class NHX tags of every leaf. \
+               The parser table is only used for the colors and shapes of each SeqType label \
+               (Parser Strings are ignored).")
+
 # Add Shape Data - classification
 st.subheader("Binary Shape Classification")
 # circle - default, square - set to parse
@@ -217,6 +417,52 @@ with st.expander("Tree Visualization Options"):
     if threshold_slider != 1e-06:
         threshold = threshold_slider
 
+    # setting the mismatch threshold used instead when an alignment is uploaded
+    mismatch_range = [0, 1, 2, 3, 4, 5, 10, 20]
+    max_mismatches = st.select_slider(
+        "Set the clonality mismatch threshold \
+            (only used when an alignment is uploaded)",
+        options=mismatch_range,
+        value=0 # default value, identical sequences
+        )
+
+    # stacks with more clones than this are drawn as one symbol and a count
+    stack_summary_range = [10, 20, 50, 100, 200, 500]
+    stack_summary_size = st.select_slider(
+        "Summarize stacks with more clones than",
+        options=stack_summary_range,
+        value=50 # default value
+        )
+
+    # level of detail: beyond this many leaves (after stacking clones) the
+    # largest clades are drawn as wedges with their number of sequences
+    detail_range = [500, 1000, 2000, 5000, 10000, "All"]
+    detail_leaves = st.select_slider(
+        "Draw at most this many leaves",
+        options=detail_range,
+        value=DETAIL_LEAVES or "All" # default value, every leaf is drawn
+        )
+    detail_leaves = 0 if detail_leaves == "All" else detail_leaves
+    resolution_range = [0, 1e-05, 1e-04, 1e-03, 1e-02]
+    detail_resolution = st.select_slider(
+        "Draw clades shallower than this branch length as wedges",
+        options=resolution_range,
+        value=0 # default value, clades are only cut for the leaf budget
+        )
+    st.caption("Larger trees have their largest clades drawn as wedges, with the number of sequences \
+               of every SeqType next to them, in the tree shown and in its downloads")
+
+    # if turned on, clones of large trees are searched on the CPUs available
+    parallel_clones = st.toggle("Search clones in parallel")
+    if parallel_clones:
+        st.caption("Trees with at least 20,000 leaves are split into independent clades \
+                   that are searched on the CPUs available (the clones found are the same)")
+
+    # if turned on, the tree is drawn by ete3 (PyQt5) instead of written directly as SVG
+    ete3_on = st.toggle("Draw with ete3")
+    if ete3_on:
+        st.caption("The previous renderer, much slower on large trees")
+
     # if turned on, then leaf names will show
     leaf_name_bool = False
     leaf_name_on = st.toggle("Show Node Name")
@@ -237,54 +483,160 @@ with st.expander("Tree Visualization Options"):
 kwargs = {
     "ts_scale": ts_scale_parameter,
     "clone_threshold": threshold,
+    "parallel_clones": parallel_clones,
+    "max_mismatches": max_mismatches,
+    "stack_summary_size": stack_summary_size,
+    "detail_leaves": detail_leaves,
+    "detail_resolution": detail_resolution,
+    "renderer": "ete3" if ete3_on else "native",
     "leaf_name_bool": leaf_name_bool,
-    "rooting_node": tree_root
+    "rooting_node": tree_root,
+    "preview": True,
+    "annotation_mode": "nhx" if nhx_on else "parser"
 }
-kwargs = pd.DataFrame([kwargs]) # convert to df
-kwargs = kwargs.to_csv(index=False)
+settings = RenderSettings(**kwargs)
 
 st.header("Tree File Upload")
 # upload file
-uploaded_file = st.file_uploader("Please upload your newick file", 
-                                 type=["tre", "nwk", "tree", "newick", "nhx"],
+uploaded_file = st.file_uploader("Please upload your newick file (may be compressed with gzip, bz2 or xz)", 
+                                 type=TREE_EXTENSIONS + COMPRESSED_EXTENSIONS,
                                  accept_multiple_files = False)
+# optional alignment, clones are then called on mismatches instead of branch lengths
+alignment_upload = st.file_uploader("Optionally upload the FASTA alignment of the tree's sequences \
+                                    to call clones by mismatch counts", 
+                                    type=ALIGNMENT_EXTENSIONS + COMPRESSED_EXTENSIONS,
+                                    accept_multiple_files = False)
 
 if uploaded_file:
     # Check that parser table is updated
     if edited_df.equals(default_parser):
         st.warning('Warning: seems like you have not updated the parser table. Results may be unexpected!', icon="⚠️")
-    # creates a file in writing mode
-    temp_filename = "uploaded_tree.tre"
-    with open(temp_filename,'w+b') as f:
-        # writes the tree to the file
-        f.write(uploaded_file.getbuffer())
+    # the tree is read straight from the upload, compressed or not
+    tree_bytes = bytes(uploaded_file.getbuffer())
+
+    # clones for the chosen threshold are looked up in the cached analysis
+    try:
+        clone_table = analyse_clones(tree_bytes, tree_root, tuple(clone_range), parallel_clones)
+    except (RenderQueueFull, RenderJobStopped) as e:
+        st.error(f"Error in searching the tree for clones. {job_error(e)}")
+        st.stop()
+    except Exception:
+        clone_table = None  # let the render engine report the problem
+    # with an alignment, the clones for the chosen mismatch threshold are used instead
+    alignment_table = None
+    if clone_table is not None and alignment_upload:
+        try:
+            alignment_table = analyse_alignment_clones(tree_bytes, tree_root, bytes(alignment_upload.getbuffer()),
+                                                       tuple(mismatch_range))
+        except ValueError as e:
+            st.error(f"Alignment could not be used ({e}). Clones are called from branch lengths instead.")
+        except (RenderQueueFull, RenderJobStopped) as e:
+            st.error(f"Error in comparing the aligned sequences. {job_error(e)}")
+            st.stop()
+    clones = None  # the render engine calls them itself
+    if alignment_table is not None:
+        clones = pd.DataFrame({"leaf": alignment_table["leaf"],
+                               "leader": clone_groups_at(alignment_table, max_mismatches)})
+    elif clone_table is not None:
+        try:
+            clones = clone_groups(tree_bytes, tree_root, tuple(clone_range), threshold)
+        except (RenderQueueFull, RenderJobStopped) as e:
+            st.error(f"Error in searching the tree for clones. {job_error(e)}")
+            st.stop()
 
     # serializing df to csv
     df_csv = edited_df.to_csv(index=False)
+    class_csv = edited_shape.to_csv(index=False) if on else ""
+    # the tables are read back from CSV, as the render engine has always read them
+    parser_df = pd.read_csv(StringIO(df_csv))
+    class_df = pd.read_csv(StringIO(class_csv)) if on else None
 
-    if on:
-        class_csv = edited_shape.to_csv(index=False)
-        # run tree-render-function.py and pass the temp tree file as an argument
-        subprocess.run([f"{sys.executable}", "tree-render-function.py", temp_filename, df_csv, class_csv, kwargs])
-    else:
-        # run tree-render-function.py and pass the temp tree file as an argument
-        subprocess.run([f"{sys.executable}", "tree-render-function.py", temp_filename, df_csv, kwargs])
+    # everything the drawing depends on but the colors and shapes of the parser table
+    render_key = tuple(hashlib.sha256(part).hexdigest() for part in [
+        tree_bytes, bytes(alignment_upload.getbuffer()) if alignment_upload else b"",
+        edited_df.drop(columns=["Color", "Shape"], errors="ignore").to_csv(index=False).encode(),
+        class_csv.encode(), json.dumps(kwargs).encode()])
 
-    # display tree
-    if os.path.exists("data/tree-file.png"):
+    # edits of only colors and shapes restyle the tree drawn last
+    if st.session_state.get("cancelled_render") == render_key:
+        # the tree was cancelled, it is drawn again when asked for or once the settings change
+        st.info("Drawing the tree was cancelled.")
+        st.button("Draw the tree again", on_click=st.session_state.pop, args=("cancelled_render",))
+    elif not restyle_rendered_tree(render_key, parser_df):
+        # the render engine is run in the render pool with the uploaded tree
+        result = render_with_preview(render_key, tree_bytes, parser_df, settings, class_df, None, clones)
+        keep_rendered_tree(render_key, parser_df, result)
+
+    # display tree, only the SVG is rendered
+    rendered = st.session_state.get("rendered_tree")
+    if rendered is not None and rendered["key"] == render_key:
         st.header("Tree Visualization")
-        # st.image("data/tree-file.png")
-        st.image("data/tree-file.svg", width=10000)
-        # with open("data/tree-file.pdf", "rb") as file:
-        #     today_date = datetime.now().strftime("%Y-%m-%d")
-        #     download_filename = f"tree-{today_date}.pdf"
-        #     st.download_button(label = "Download Tree File as a PDF", data = file, file_name = download_filename, mime="application/pdf")
-        with open("data/tree-file.svg", "rb") as file:
-            today_date = datetime.now().strftime("%Y-%m-%d")
-            download_filename = f"tree-{today_date}.svg"
-            st.download_button(label = "Download Tree as a SVG", data = file, file_name = download_filename, mime="image/svg+xml")
-    else: 
-        st.error("Error in creating tree. tree-file image not found.")
+        show_svg(rendered["svg"], "tree")
+        today_date = datetime.now().strftime("%Y-%m-%d")
+        download_filename = f"tree-{today_date}.svg"
+        st.download_button(label = "Download Tree as a SVG", data = rendered["svg"], file_name = download_filename, mime="image/svg+xml")
+        # PDF and PNG files are only made from the SVG when asked for
+        with st.expander("Other file formats"):
+            export_format = st.radio("File format", ["PDF", "PNG"], horizontal=True)
+            export_dpi = EXPORT_DPI
+            if export_format == "PNG":
+                export_dpi = st.select_slider("PNG resolution (dpi)", options=[100, 200, 300, 600], value=EXPORT_DPI)
+            if st.button(f"Create {export_format}"):
+                from tree_export import export_bytes  # run in the render pool, where Qt is started
+                try:
+                    export_data = render_pool().run(export_bytes, rendered["svg"], export_format.lower(), export_dpi)
+                except Exception as e:
+                    st.error(f"Error in creating the {export_format} file. {job_error(e)}")
+                else:
+                    st.download_button(label = f"Download Tree as a {export_format}", data = export_data,
+                                       file_name = f"tree-{today_date}.{export_format.lower()}",
+                                       mime = EXPORT_FORMATS[export_format.lower()], on_click="ignore")
+        # a clade of the analysed tree is drawn on its own, without reading
+        # the tree or calling clones again
+        if "tree_analysis" in st.session_state:
+            with st.expander("Drill down into a clade"):
+                clade_query = st.text_input("Sequence names, or parts of names such as a participant or \
+                                            timepoint, separated by commas (the clade of their common ancestor is drawn)")
+                if clade_query:
+                    try:
+                        clade_svg = render_pool().run(render_clade, st.session_state["tree_analysis"], clade_query,
+                                                      parser_df, settings)
+                    except Exception as e:
+                        # such as "ValueError: No sequence called ..."
+                        st.error(f"Error in drawing the clade. {job_error(e)}")
+                    else:
+                        show_svg(clade_svg, "clade")
+                        st.download_button(label = "Download Clade as a SVG", data = clade_svg,
+                                           file_name = f"clade-{today_date}.svg", mime="image/svg+xml")
+        if clone_table is not None:
+            try:
+                distance_df = clone_distances(tree_bytes, tree_root, clones)
+            except Exception as e:
+                st.error(f"Error in measuring the clone distances. {job_error(e)}")
+            else:
+                st.download_button(label = "Download Clone Distances as a CSV", data = distance_df.to_csv(index=False),
+                                   file_name = f"clone-distances-{today_date}.csv", mime="text/csv")
+                st.caption("Within-clone distances and the closest sequence outside of the clone for every stacked node")
+
+    # number of stacked nodes at every threshold of the slider
+    if clone_table is not None:
+        with st.expander("Stacked nodes vs. clonality threshold"):
+            if alignment_table is not None:  # mismatch counts, starting at 0
+                curve = stacked_node_curve(alignment_table)
+                x_axis = alt.X("Threshold", title="Mismatches")
+                current = max_mismatches
+            else:
+                curve = stacked_node_curve(clone_table)
+                x_axis = alt.X("Threshold", scale=alt.Scale(type="log"))
+                current = threshold
+            chart = alt.Chart(curve).mark_line(point=True).encode(
+                x=x_axis,
+                y="Stacked nodes",
+                tooltip=["Threshold", "Stacked nodes", "Leading nodes", "Clones"]
+            )
+            rule = alt.Chart(pd.DataFrame({"Threshold": [current]})).mark_rule(strokeDash=[4, 4]).encode(x="Threshold")
+            st.altair_chart(chart + rule, use_container_width=True)
+            st.caption("Dashed line marks the current threshold. Use this to pick a threshold without re-rendering the tree.")
 
 # Footer
 st.markdown("---")
@@ -0,0 +1,219 @@
+"""
+alignment_clones.py
+    This python file contains the alignment based clone
+    detection, used when a FASTA alignment of the leaves is
+    uploaded next to the tree. Clones are then leaves whose
+    sequences differ by at most a number of mismatches, not
+    leaves within a branch length threshold.
+    Sequences are packed 2 bits per base into 64-bit words,
+    so comparing two sequences is an XOR and a popcount over
+    ~L/32 words, and each leading leaf is only compared to
+    the leaves of its clade neighbourhood.
+    The groups found have the same form as the ones from
+    clone_detection, so stacking and rendering are unchanged.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import numpy as np
+import pandas as pd
+
+from newick_reader import open_tree_stream
+
+# file extensions the alignment uploader accepts
+ALIGNMENT_EXTENSIONS = ["fasta", "fa", "fas", "fna", "aln"]
+
+# largest clade (in leaves) a leading leaf is compared against
+NEIGHBOURHOOD = 128
+
+# 2-bit codes of the bases, anything else (gaps, N, ambiguity codes) is
+# not compared
+_BASE_CODE = np.zeros(256, dtype=np.uint64)
+_BASE_VALID = np.zeros(256, dtype=bool)
+for _code, _bases in enumerate(["Aa", "Cc", "Gg", "TtUu"]):
+    for _base in _bases:
+        _BASE_CODE[ord(_base)] = _code
+        _BASE_VALID[ord(_base)] = True
+_SHIFTS = np.arange(0, 64, 2, dtype=np.uint64)  # 32 bases per word
+
+
+class PackedAlignment:
+    """
+    This class holds an alignment packed 2 bits per base. Sequences are
+    looked up by their FASTA name (the whole header line or its first
+    word). codes holds the bases and valid has the low bit of a base set
+    where it is A, C, G or T/U.
+    """
+
+    def __init__(self, names, sequences):
+        lengths = {len(sequence) for sequence in sequences}
+        if len(lengths) > 1:
+            raise ValueError("Sequences of the alignment do not all have the same length")
+        length = lengths.pop() if lengths else 0
+        words = -(-length // 32)
+        self.names = list(names)
+        self.length = length
+        self.codes = np.zeros((len(sequences), words), dtype=np.uint64)
+        self.valid = np.zeros((len(sequences), words), dtype=np.uint64)
+        for i, sequence in enumerate(sequences):
+            raw = np.zeros(words * 32, dtype=np.uint8)
+            raw[:length] = np.frombuffer(sequence.encode("ascii", "replace"), dtype=np.uint8)
+            raw = raw.reshape(words, 32)
+            self.codes[i] = (_BASE_CODE[raw] << _SHIFTS).sum(axis=1, dtype=np.uint64)
+            self.valid[i] = (_BASE_VALID[raw].astype(np.uint64) << _SHIFTS).sum(axis=1, dtype=np.uint64)
+        self.row = {}
+        for i, name in enumerate(self.names):
+            self.row.setdefault(name, i)
+        for i, name in enumerate(self.names):
+            if name.split():
+                self.row.setdefault(name.split()[0], i)
+
+    def rows_of(self, names):
+        """
+        This function returns the alignment row of every name (-1 for
+        names without a sequence).
+        """
+        return np.fromiter((self.row.get(name, -1) for name in names), dtype=np.int64, count=len(names))
+
+    def mismatches(self, i, rows):
+        """
+        This function returns the number of mismatches between row i and
+        every row in rows, over the positions that are A, C, G or T in
+        both sequences.
+        """
+        x = self.codes[rows] ^ self.codes[i]
+        differ = (x | (x >> np.uint64(1))) & self.valid[rows] & self.valid[i]
+        return np.bitwise_count(differ).sum(axis=1, dtype=np.int64)
+
+
+def read_fasta(source):
+    """
+    This function reads a FASTA alignment from source (a path, bytes or a
+    binary file object, possibly gzip, bz2 or xz compressed) and returns
+    it as a PackedAlignment.
+    """
+    names = []
+    sequences = []
+    parts = None
+    with open_tree_stream(source) as text:
+        for line in text:
+            line = line.strip()
+            if line.startswith(">"):
+                if parts is not None:
+                    sequences.append("".join(parts))
+                names.append(line[1:].strip())
+                parts = []
+            elif line:
+                if parts is None:
+                    raise ValueError("Alignment is not in FASTA format (it should start with '>')")
+                parts.append(line)
+    if parts is not None:
+        sequences.append("".join(parts))
+    if not names:
+        raise ValueError("Alignment is empty")
+    return PackedAlignment(names, sequences)
+
+
+def find_alignment_clone_groups(t, alignment, max_mismatches, neighbourhood=NEIGHBOURHOOD):
+    """
+    This function returns, for every leaf of t in iter_leaves() order,
+    the position of the leading leaf it is stacked onto, with clones
+    being leaves at most max_mismatches apart in the alignment.
+    It follows the same greedy pass as clone_detection.find_clone_groups().
+    """
+    return _greedy_alignment_pass(t, alignment, [max_mismatches], neighbourhood)[0]
+
+
+def alignment_merge_table(t, alignment, thresholds, neighbourhood=NEIGHBOURHOOD):
+    """
+    This function runs the alignment clone search for a range of
+    mismatch thresholds at once and returns a table of the same form as
+    clone_detection.clone_merge_table(), so clone_groups_at() and
+    stacked_node_curve() can be used on it.
+    """
+    thresholds = sorted(thresholds)
+    columns = _greedy_alignment_pass(t, alignment, thresholds, neighbourhood)
+    table = pd.DataFrame({"leaf": t.leaf_names()})
+    for threshold, leader_of in zip(thresholds, columns):
+        table[threshold] = leader_of
+    position = np.arange(len(table))
+    merge_height = np.full(len(table), np.nan)
+    for threshold, leader_of in reversed(list(zip(thresholds, columns))):
+        merge_height[np.asarray(leader_of) != position] = threshold
+    table["merge_height"] = merge_height
+    return table
+
+
+def _greedy_alignment_pass(t, alignment, thresholds, neighbourhood):
+    """
+    This function runs the greedy clone pass on mismatch counts for
+    several ascending thresholds at once. Leaves are visited in order
+    and every leaf that is not yet claimed becomes a leading leaf that
+    claims the unclaimed leaves of its neighbourhood within threshold.
+    Leaves without a sequence are never stacked.
+    """
+    n = len(t.leaves)
+    rows = alignment.rows_of(t.leaf_names())
+    lo, hi = _neighbourhoods(t, neighbourhood)
+    position = np.arange(n)
+
+    columns = np.full((len(thresholds), n), -1, dtype=np.int64)
+    limits = np.asarray(thresholds)
+    for k in range(n):
+        open_levels = np.flatnonzero(columns[:, k] == -1)
+        if len(open_levels) == 0:
+            continue
+        columns[open_levels, k] = k
+        if rows[k] == -1:
+            continue
+        candidates = position[lo[k]:hi[k]]
+        candidates = candidates[(rows[candidates] != -1)
+                                & (columns[open_levels[:, None], candidates] == -1).any(axis=0)]
+        if len(candidates) == 0:
+            continue
+        mismatches = alignment.mismatches(rows[k], rows[candidates])
+        for j in open_levels:
+            claimed = candidates[(mismatches <= limits[j]) & (columns[j, candidates] == -1)]
+            columns[j, claimed] = k
+    return [column.tolist() for column in columns]
+
+
+def _neighbourhoods(t, neighbourhood):
+    """
+    This function returns, for every leaf position, the range of leaf
+    positions it is compared against: the largest clade holding it with
+    at most neighbourhood leaves, or the neighbourhood around it inside
+    its parent's clade when that clade alone is larger.
+    Clades are ranges of leaf positions because leaves come in preorder.
+    """
+    n_nodes = len(t)
+    parent = t.parent.tolist()
+    first = [n_nodes] * n_nodes  # first and one past the last leaf position
+    last = [0] * n_nodes
+    for k, leaf in enumerate(t.leaves.tolist()):
+        first[leaf] = k
+        last[leaf] = k + 1
+    for node in range(n_nodes - 1, 0, -1):
+        up = parent[node]
+        first[up] = min(first[up], first[node])
+        last[up] = max(last[up], last[node])
+
+    # largest clade at or above every node that is still small enough
+    top = list(range(n_nodes))
+    for node in range(1, n_nodes):
+        up = parent[node]
+        if last[up] - first[up] <= neighbourhood:
+            top[node] = top[up]
+
+    leaves = t.leaves.tolist()
+    lo = np.zeros(len(leaves), dtype=np.int64)
+    hi = np.zeros(len(leaves), dtype=np.int64)
+    half = neighbourhood // 2
+    for k, leaf in enumerate(leaves):
+        clade = top[leaf]
+        if clade == leaf and parent[leaf] != -1:
+            clade = parent[leaf]
+            lo[k] = max(first[clade], k - half)
+            hi[k] = min(last[clade], k + half + 1)
+        else:
+            lo[k], hi[k] = first[clade], last[clade]
+    return lo, hi
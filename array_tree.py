@@ -0,0 +1,444 @@
+"""
+array_tree.py
+    This python file contains the compact tree model used by
+    the analysis in tree-render-function.py and the Homepage.
+    A tree is stored as NumPy arrays in preorder (parent index,
+    child offsets, branch length, support, name id and leaf
+    annotation codes, plus any NHX tags read with the tree)
+    instead of one ete3 TreeNode per node.
+    Rooting, ladderizing and collapsing clones are done on the
+    arrays and give the same tree ete3 would; only the reduced
+    tree handed to the renderer is turned back into ete3.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import numpy as np
+
+
+class ArrayTree:
+    """
+    This class holds a tree with its nodes numbered in preorder (the
+    root is node 0, leaves come in iter_leaves() order). The children
+    of node i are child_idx[child_ptr[i]:child_ptr[i + 1]].
+    Operations that change the topology return a new ArrayTree.
+    NHX tags are kept in features, one object array (None where a node
+    has no such tag) per tag name.
+    """
+
+    def __init__(self, parent, child_ptr, child_idx, dist, support, name_id, names,
+                 seqtype=None, classification=None, features=None):
+        self.parent = parent
+        self.child_ptr = child_ptr
+        self.child_idx = child_idx
+        self.dist = dist
+        self.support = support
+        self.name_id = name_id
+        self.names = names  # table of distinct names, indexed by name_id
+        n = len(parent)
+        self.seqtype = np.full(n, -1, dtype=np.int32) if seqtype is None else seqtype
+        self.classification = np.full(n, -1, dtype=np.int8) if classification is None else classification
+        self.features = {} if features is None else features
+        self.leaves = np.flatnonzero(child_ptr[1:] == child_ptr[:-1])
+
+    @classmethod
+    def from_children(cls, root, children, dist, support, name_id, names,
+                      seqtype=None, classification=None, features=None):
+        """
+        This function builds an ArrayTree from children lists of nodes
+        numbered in any order, with the per node values given in that
+        same numbering. It also returns the old number of every node.
+        """
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(reversed(children[node]))
+        new_index = np.full(len(children), -1, dtype=np.int64)
+        new_index[order] = np.arange(len(order))
+
+        counts = np.array([len(children[node]) for node in order], dtype=np.int64)
+        child_idx = new_index[np.fromiter((child for node in order for child in children[node]),
+                                          dtype=np.int64, count=int(counts.sum()))]
+        child_ptr = np.concatenate(([0], np.cumsum(counts)))
+        parent = np.full(len(order), -1, dtype=np.int64)
+        parent[child_idx] = np.repeat(np.arange(len(order)), counts)
+
+        order = np.asarray(order, dtype=np.int64)
+        take = lambda values, dtype: None if values is None else np.asarray(values, dtype=dtype)[order]
+        tree = cls(parent, child_ptr, child_idx, take(dist, np.float64), take(support, np.float64),
+                   take(name_id, np.int64), names, take(seqtype, np.int32), take(classification, np.int8),
+                   {tag: take(values, object) for tag, values in (features or {}).items()})
+        return tree, order
+
+    @classmethod
+    def from_ete(cls, t):
+        """
+        This function builds an ArrayTree from an ete3 tree.
+        """
+        nodes = list(t.traverse("preorder"))
+        position = {node: i for i, node in enumerate(nodes)}
+        names = []
+        name_ids = {}
+        name_id = []
+        children = []
+        for node in nodes:
+            if node.name not in name_ids:
+                name_ids[node.name] = len(names)
+                names.append(node.name)
+            name_id.append(name_ids[node.name])
+            children.append([position[child] for child in node.children])
+        tree, order = cls.from_children(0, children, [node.dist for node in nodes],
+                                        [node.support for node in nodes], name_id, names)
+        return tree
+
+    def __len__(self):
+        return len(self.parent)
+
+    def children_lists(self):
+        """
+        This function returns the children of every node as lists.
+        """
+        ptr = self.child_ptr.tolist()
+        idx = self.child_idx.tolist()
+        return [idx[ptr[i]:ptr[i + 1]] for i in range(len(ptr) - 1)]
+
+    def leaf_names(self):
+        """
+        This function returns the names of the leaves in iter_leaves() order.
+        """
+        return [self.names[i] for i in self.name_id[self.leaves]]
+
+    def leaf_feature(self, tag):
+        """
+        This function returns the value of an NHX tag for every leaf in
+        iter_leaves() order (None for leaves without it).
+        """
+        if tag not in self.features:
+            return [None] * len(self.leaves)
+        return self.features[tag][self.leaves].tolist()
+
+    def search(self, name):
+        """
+        This function returns the nodes called name (like ete3's
+        search_nodes(name=name)).
+        """
+        matches = [i for i, node_name in enumerate(self.names) if node_name == name]
+        if not matches:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(np.isin(self.name_id, matches))
+
+    def midpoint_outgroup(self):
+        """
+        This function returns the node that splits the tree into two
+        distance-balanced halves, found the way ete3's
+        get_midpoint_outgroup() finds it.
+        """
+        children = self.children_lists()
+        dist = self.dist.tolist()
+        parent = self.parent.tolist()
+
+        # farthest leaf from the root, then the farthest node from it
+        far_a, _ = _farthest_leaf(0, children, dist)
+        farthest_node, farthest_dist = far_a, 0.0
+        previous = far_a
+        cdist = dist[previous]
+        current = parent[previous]
+        while current != -1:
+            for child in children[current]:
+                if child != previous:
+                    if children[child]:
+                        fnode, fdist = _farthest_leaf(child, children, dist)
+                    else:
+                        fnode, fdist = child, 0
+                    fdist += dist[child]
+                    if cdist + fdist > farthest_dist:
+                        farthest_dist = cdist + fdist
+                        farthest_node = fnode
+            previous = current
+            cdist += dist[previous]
+            current = parent[previous]
+
+        # climb from the first leaf until half of the way is passed
+        middist = farthest_dist / 2.0
+        cdist = 0
+        current = far_a
+        while current != -1:
+            cdist += dist[current]
+            if cdist > middist:
+                break
+            current = parent[current]
+        if current == -1:
+            current = children[0][0]  # already at midpoint
+        return current
+
+    def set_outgroup(self, outgroup):
+        """
+        This function returns the tree rerooted so that outgroup is the
+        first child of the root, following ete3's set_outgroup() step
+        by step so branch lengths, supports and child order match.
+        """
+        if outgroup == 0:
+            raise ValueError("Cannot set myself as outgroup")
+        children = self.children_lists()
+        parent = self.parent.tolist()
+        dist = self.dist.tolist()
+        support = self.support.tolist()
+        name_id = self.name_id.tolist()
+        names = self.names
+        seqtype = self.seqtype.tolist()
+        classification = self.classification.tolist()
+        features = {tag: values.tolist() for tag, values in self.features.items()}
+        root = 0
+
+        parent_outgroup = parent[outgroup]
+        n = outgroup
+        while parent[n] != root:
+            n = parent[n]
+
+        # if outgroup is a child from root, but with more than one
+        # sister nodes, creates a new node to group them
+        children[root].remove(n)
+        if len(children[root]) != 1:
+            connector = len(children)
+            if "" not in names:
+                names = names + [""]
+            children.append(list(children[root]))
+            parent.append(-1)
+            dist.append(0.0)
+            support.append(support[n])
+            name_id.append(names.index(""))
+            seqtype.append(-1)
+            classification.append(-1)
+            for values in features.values():
+                values.append(None)
+            for child in children[connector]:
+                parent[child] = connector
+            children[root] = []
+        else:
+            connector = children[root][0]
+
+        # connects down branch to myself or to outgroup
+        new_parent = parent_outgroup
+        if new_parent != root:
+            # parent-child swapping along the path to the root
+            new_child = parent[new_parent]
+            former_parent = -1
+            buffered_dist = dist[new_parent]
+            buffered_support = support[new_parent]
+            while new_child != root:
+                children[new_parent].append(new_child)
+                children[new_child].remove(new_parent)
+                buffered_dist, dist[new_child] = dist[new_child], buffered_dist
+                buffered_support, support[new_child] = support[new_child], buffered_support
+                parent[new_parent] = former_parent
+                former_parent = new_parent
+                new_parent = new_child
+                new_child = parent[new_parent]
+            children[new_parent].append(connector)
+            parent[connector] = new_parent
+            parent[new_parent] = former_parent
+            dist[connector] += buffered_dist
+            outgroup2 = parent_outgroup
+            children[parent_outgroup].remove(outgroup)
+            dist[outgroup2] = 0
+        else:
+            outgroup2 = connector
+
+        parent[outgroup] = root
+        parent[outgroup2] = root
+        children[root] = [outgroup, outgroup2]
+        middist = (dist[outgroup2] + dist[outgroup]) / 2
+        dist[outgroup] = middist
+        dist[outgroup2] = middist
+        support[outgroup2] = support[outgroup]
+        tree, order = ArrayTree.from_children(root, children, dist, support, name_id, names,
+                                              seqtype, classification, features)
+        return tree
+
+    def ladderize(self):
+        """
+        This function returns the tree with the children of every node
+        sorted by their number of leaves (smallest first, ties keep their
+        order), like ete3's ladderize().
+        """
+        children = self.children_lists()
+        parent = self.parent.tolist()
+        size = [0 if kids else 1 for kids in children]  # leaves below every node
+        for i in range(len(self) - 1, 0, -1):
+            size[parent[i]] += size[i]
+        for kids in children:
+            kids.sort(key=size.__getitem__)
+        tree, order = ArrayTree.from_children(0, children, self.dist, self.support, self.name_id,
+                                              self.names, self.seqtype, self.classification, self.features)
+        return tree
+
+    def collapse(self, leaves_to_keep):
+        """
+        This function returns the tree without the leaves that are not
+        in leaves_to_keep (node indices), splicing out internal nodes
+        left with a single child and adding their branch length to it,
+        and the node of this tree every node of the new tree came from.
+        It gives the tree ete3's prune(leaves_to_keep,
+        preserve_branch_length=True) gives, including ete3 moving a
+        spliced child to the end of its new parent's children and
+        merging the common ancestor of all kept leaves into the root,
+        but in a single post-order pass.
+        """
+        children = self.children_lists()
+        dist = self.dist.tolist()
+        parent = self.parent.tolist()
+        keep = np.zeros(len(self), dtype=bool)
+        keep[np.asarray(leaves_to_keep, dtype=np.int64)] = True
+        total = int(keep.sum())
+        removed = np.zeros(len(self), dtype=bool)
+        kept_below = keep.astype(np.int64)  # number of kept leaves in every clade
+
+        for node in _postorder(children):
+            if node == 0 or keep[node]:
+                continue
+            # children removed earlier in the pass are skipped here rather
+            # than taken out of the list one by one
+            alive = [child for child in children[node] if not removed[child]]
+            kept_below[node] = sum(kept_below[child] for child in alive)
+            if len(alive) > 1 and kept_below[node] < total:
+                children[node] = alive  # still joins kept leaves, stays
+                continue
+            removed[node] = True
+            up = parent[node]
+            if len(alive) == 1:
+                dist[alive[0]] += dist[node]
+            elif len(alive) > 1:
+                # like ete3, the common ancestor of all kept leaves (and
+                # any node above it) is merged into the root of the tree
+                dist[up] += dist[node]
+            for child in alive:
+                children[up].append(child)
+                parent[child] = up
+            children[node] = []
+        children[0] = [child for child in children[0] if not removed[child]]
+        return ArrayTree.from_children(0, children, dist, self.support, self.name_id, self.names,
+                                       self.seqtype, self.classification, self.features)
+
+    def cut(self, nodes):
+        """
+        This function returns the tree with the clades below nodes cut
+        off, so those nodes are leaves of the new tree, and the node of
+        this tree every node of the new tree came from.
+        """
+        children = self.children_lists()
+        for node in np.asarray(nodes, dtype=np.int64).tolist():
+            children[node] = []
+        return ArrayTree.from_children(0, children, self.dist, self.support, self.name_id, self.names,
+                                       self.seqtype, self.classification, self.features)
+
+    def subtree(self, node):
+        """
+        This function returns the clade below node as a tree of its own,
+        with no branch above its root, and the node of this tree every
+        node of the new tree came from.
+        """
+        dist = self.dist.copy()
+        dist[node] = 0.0
+        return ArrayTree.from_children(node, self.children_lists(), dist, self.support, self.name_id, self.names,
+                                       self.seqtype, self.classification, self.features)
+
+    def common_ancestor(self, nodes):
+        """
+        This function returns the deepest node with all of nodes in its
+        clade (like ete3's get_common_ancestor()).
+        """
+        nodes = np.asarray(nodes, dtype=np.int64)
+        parent = self.parent.tolist()
+        nodes_below = [1] * len(self)
+        for i in range(len(self) - 1, 0, -1):
+            nodes_below[parent[i]] += nodes_below[i]
+        # in preorder, the clade of a node is the run of nodes from it
+        node, last = int(nodes.min()), int(nodes.max())
+        while node + nodes_below[node] <= last:
+            node = parent[node]
+        return node
+
+    def to_ete(self, leaf_features=None):
+        """
+        This function returns the tree as an ete3 Tree. leaf_features
+        maps feature names to a list of values, one per leaf in
+        iter_leaves() order, that are added to the leaves.
+        """
+        from ete3 import Tree
+
+        nodes = []
+        for i in range(len(self)):
+            node = Tree()
+            node.name = self.names[self.name_id[i]]
+            node.dist = float(self.dist[i])
+            node.support = float(self.support[i])
+            if self.parent[i] != -1:
+                nodes[self.parent[i]].add_child(node)
+            nodes.append(node)
+        for feature, values in (leaf_features or {}).items():
+            for leaf, value in zip(self.leaves, values):
+                nodes[leaf].add_feature(feature, value)
+        return nodes[0]
+
+
+def prepare_tree(t, rooting_node):
+    """
+    This function roots the tree on rooting_node (or at the midpoint
+    if it is 'midpoint' or not a node of the tree) and ladderizes it.
+    The leaf order it leaves behind is the order clones are searched in.
+    """
+    if rooting_node == 'midpoint':
+        outgroup = t.midpoint_outgroup()
+    else:
+        matches = t.search(rooting_node)
+        if len(matches) > 1:
+            raise ValueError(f"Ambiguous node name: {rooting_node}")
+        elif len(matches) == 1:
+            outgroup = int(matches[0])
+        else:  # if the node is not valid, then reverts to midpoint
+            outgroup = t.midpoint_outgroup()
+    return t.set_outgroup(outgroup).ladderize()
+
+
+def _farthest_leaf(start, children, dist):
+    """
+    This function returns the farthest leaf below start and its
+    distance, summing branch lengths in the same order as ete3 so that
+    ties are broken the same way.
+    """
+    if not children[start]:
+        return start, 0.0
+    farthest, farthest_dist = None, None
+    d = 0.0
+    stack = [(child, False) for child in reversed(children[start])]
+    while stack:
+        node, leaving = stack.pop()
+        if leaving:
+            d -= dist[node]
+        elif not children[node]:
+            total = d + dist[node]
+            if farthest_dist is None or total > farthest_dist:
+                farthest, farthest_dist = node, total
+        else:
+            d += dist[node]
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children[node]))
+    return farthest, farthest_dist
+
+
+def _postorder(children):
+    """
+    This function returns the nodes in post-order (children first, in
+    order, then their parent).
+    """
+    order = []
+    stack = [(0, False)]
+    while stack:
+        node, leaving = stack.pop()
+        if leaving:
+            order.append(node)
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children[node]))
+    return order
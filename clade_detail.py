@@ -0,0 +1,116 @@
+"""
+clade_detail.py
+    This python file contains the level of detail of the drawn
+    tree. Trees with more leaves than the detail budget (after
+    the clones are stacked) have their largest clades drawn as
+    a single wedge with the number of sequences of every
+    SeqType, and so do clades shallower than the branch length
+    resolution, so the cost of drawing a tree depends on the
+    budget and not on the number of sequences.
+    Only the drawing is cut down: clones are still searched on
+    the whole tree.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import heapq
+import math
+
+import numpy as np
+
+from stack_layout import CIRCLE
+
+# leaves drawn at most before clades are drawn as wedges, by default every
+# leaf is drawn so downloaded figures are only simplified when asked for
+DETAIL_LEAVES = 0
+# leaves drawn at most in the preview shown while the tree is drawn
+PREVIEW_LEAVES = 300
+
+WEDGE_MIN_WIDTH = 8  # width of wedges of clades with no depth, in pixels
+WEDGE_COLOR = "#DDDDDD"
+
+
+def plan_wedges(t, max_leaves=DETAIL_LEAVES, resolution=0.0):
+    """
+    This function returns the nodes of the ArrayTree t whose clades are
+    drawn as wedges. Clades are opened from the root down, the largest
+    first, as long as the leaves and wedges drawn stay within max_leaves
+    (0 opens them all), and clades shallower than resolution (the
+    longest path from the clade's root to its leaves) are never opened.
+    """
+    child_ptr = t.child_ptr.tolist()
+    child_idx = t.child_idx.tolist()
+    leaves_below = clade_leaves(t)
+    depth = clade_depths(t)
+    budget = max_leaves if max_leaves else math.inf
+
+    wedges = []
+    drawn = 1  # the root, as a single wedge
+    queue = [(-leaves_below[0], 0)]
+    while queue:
+        size, node = heapq.heappop(queue)
+        children = child_idx[child_ptr[node]:child_ptr[node + 1]]
+        if not children:
+            continue
+        if depth[node] < resolution or drawn + len(children) - 1 > budget:
+            wedges.append(node)
+            continue
+        drawn += len(children) - 1
+        for child in children:
+            heapq.heappush(queue, (-leaves_below[child], child))
+    return np.array(sorted(wedges), dtype=np.int64)
+
+
+def clade_leaves(t):
+    """
+    This function returns the number of leaves below every node of t.
+    """
+    parent = t.parent.tolist()
+    leaves_below = [0] * len(t)
+    for leaf in t.leaves.tolist():
+        leaves_below[leaf] = 1
+    # preorder numbering puts every child after its parent
+    for node in range(len(t) - 1, 0, -1):
+        leaves_below[parent[node]] += leaves_below[node]
+    return leaves_below
+
+
+def clade_depths(t):
+    """
+    This function returns the longest path from every node of t to the
+    leaves below it.
+    """
+    parent = t.parent.tolist()
+    dist = t.dist.tolist()
+    depth = [0.0] * len(t)
+    for node in range(len(t) - 1, 0, -1):
+        depth[parent[node]] = max(depth[parent[node]], dist[node] + depth[node])
+    return depth
+
+
+def wedge_stacks(t, wedges, leaf_counts):
+    """
+    This function returns, for every wedge node of t, the number of
+    sequences of every SeqType in its clade as a stack of (circle,
+    SeqType position, count) glyphs. leaf_counts holds the number of
+    sequences of every SeqType (columns) a leaf of t stands for, its
+    clones included (rows, in t.leaves order).
+    """
+    # the leaves of a clade are a run of t.leaves, as nodes are in preorder
+    parent = t.parent.tolist()
+    nodes_below = [1] * len(t)
+    for node in range(len(t) - 1, 0, -1):
+        nodes_below[parent[node]] += nodes_below[node]
+    wedges = np.asarray(wedges, dtype=np.int64)
+    first = np.searchsorted(t.leaves, wedges)
+    last = np.searchsorted(t.leaves, wedges + np.asarray(nodes_below, dtype=np.int64)[wedges])
+    cumulative = np.vstack([np.zeros((1, leaf_counts.shape[1]), dtype=np.int64), np.cumsum(leaf_counts, axis=0)])
+    counts = cumulative[last] - cumulative[first]
+    return [tuple((CIRCLE, int(k), int(row[k])) for k in np.flatnonzero(row)) for row in counts]
+
+
+def wedge_size(depth, leaves, scale):
+    """
+    This function returns the width and height in pixels of the wedge of
+    a clade of the given depth and number of leaves.
+    """
+    return max(depth * scale, WEDGE_MIN_WIDTH), 8 + 4 * math.log2(max(leaves, 1))
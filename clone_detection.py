@@ -0,0 +1,475 @@
+"""
+clone_detection.py
+    This python file contains the clone detection used by
+    tree-render-function.py to find clonal leaves that are
+    stacked onto a single leading node.
+    Instead of measuring the distance between every pair
+    of leaves, each leading leaf only searches the clades
+    that are close enough to hold a clone. Trees are given
+    as array_tree.ArrayTree.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# relative slack added to the threshold when pruning clades, leaves found
+# inside the slack are confirmed with the same summation ete3 uses
+PRUNE_SLACK = 1e-9
+
+# trees with fewer leaves are not worth starting a process pool for
+PARALLEL_MIN_LEAVES = 20000
+# clades are packed into this many tasks per process, to even out the load
+TASKS_PER_WORKER = 4
+# a search never starts more processes than this
+MAX_CLONE_WORKERS = 16
+# the number of processes sharing the CPUs, which may each search at the
+# same time (every render worker sets it to the size of its pool)
+CPU_SHARE = 1
+# how the processes of a search are started, None to fork them from single
+# threaded processes (like tree-render-function.py) and spawn them otherwise
+# (render workers start a fork server before they start Qt, see
+# start_fork_server())
+START_METHOD = None
+
+
+def clone_workers(t):
+    """
+    This function returns the number of processes to search the clones
+    of t with: an even share of the CPUs this process may use (see
+    available_cpus()) for large trees, up to MAX_CLONE_WORKERS, or None
+    (a single process) for trees below PARALLEL_MIN_LEAVES leaves or
+    when there is only one CPU to use.
+    """
+    if len(t.leaves) < PARALLEL_MIN_LEAVES:
+        return None
+    workers = min(MAX_CLONE_WORKERS, available_cpus() // max(1, CPU_SHARE))
+    return workers if workers > 1 else None
+
+
+def start_fork_server():
+    """
+    This function starts the fork server that the processes of parallel
+    searches are started from, with this module loaded, and uses it from
+    then on (or spawns them where there is no fork server). It is called
+    by render workers before they import ete3 and start Qt, which may
+    start threads that forking is not safe with.
+    """
+    global START_METHOD
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        START_METHOD = "spawn"
+        return
+    from multiprocessing import forkserver
+
+    forkserver.set_forkserver_preload(["clone_detection"])
+    forkserver.ensure_running()
+    START_METHOD = "forkserver"
+
+
+def available_cpus():
+    """
+    This function returns the number of CPUs this process may use: the
+    CPUs it may run on, capped by the CPU quota of its cgroup, as
+    containers are often given fewer CPUs than they can see.
+    """
+    if hasattr(os, "process_cpu_count"):
+        cpus = os.process_cpu_count()
+    elif hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count()
+    cpus = cpus or 1
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+
+def cgroup_cpu_quota():
+    """
+    This function returns the CPU quota of the cgroup of this process in
+    CPUs, read from cpu.max (cgroup v2) or cpu.cfs_quota_us and
+    cpu.cfs_period_us (cgroup v1), or None when it has no quota.
+    """
+    # cgroup v2: "max 100000" without a quota, "<quota> <period>" with one
+    paths = ["/sys/fs/cgroup/cpu.max"]
+    try:
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    paths.insert(0, f"/sys/fs/cgroup{line[3:].strip().rstrip('/')}/cpu.max")
+    except OSError:
+        pass
+    for path in paths:
+        try:
+            with open(path) as f:
+                quota, period = f.read().split()[:2]
+        except (OSError, ValueError):
+            continue
+        if quota == "max":
+            return None
+        try:
+            return int(quota) / int(period)
+        except (ValueError, ZeroDivisionError):
+            return None
+    # cgroup v1: a quota of -1 means there is none
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return quota / period if quota > 0 and period > 0 else None
+
+
+def find_clone_groups(t, threshold, workers=None):
+    """
+    This function returns, for every leaf in iter_leaves() order, the
+    position of the leading leaf it is stacked onto (leading leaves
+    point to themselves).
+    It follows the greedy pass render_tree has always used: leaves are
+    visited in order and each leaf that is not yet accounted for
+    becomes a leading leaf that claims every unclaimed leaf within
+    threshold of it, whatever their SeqType.
+    With workers, independent clades are searched in that many
+    processes, giving the same groups.
+    """
+    return _greedy_clone_pass(t, [threshold], workers)[0]
+
+
+def clone_merge_table(t, thresholds, workers=None):
+    """
+    This function runs the clone search once for a whole range of
+    thresholds and returns a DataFrame with one row per leaf (in
+    iter_leaves() order): the leaf name, the position of its leading
+    leaf at every threshold, and its merge height (the lowest threshold
+    at which it is stacked onto another leaf, NaN if never).
+    Any threshold of the table can then be applied without measuring
+    distances again, see clone_groups_at().
+    """
+    thresholds = sorted(thresholds)
+    columns = _greedy_clone_pass(t, thresholds, workers)
+    table = pd.DataFrame({"leaf": t.leaf_names()})
+    for threshold, leader_of in zip(thresholds, columns):
+        table[threshold] = leader_of
+    position = np.arange(len(table))
+    merge_height = np.full(len(table), np.nan)
+    for threshold, leader_of in reversed(list(zip(thresholds, columns))):
+        merge_height[np.asarray(leader_of) != position] = threshold
+    table["merge_height"] = merge_height
+    return table
+
+
+def clone_groups_at(table, threshold):
+    """
+    This function returns the leading leaf positions at threshold from
+    a clone_merge_table(), or None if the threshold is not in the table.
+    """
+    for column in table.columns:
+        if column not in ("leaf", "merge_height") and np.isclose(column, threshold, rtol=1e-9, atol=0):
+            return table[column].to_list()
+    return None
+
+
+def stacked_node_curve(table):
+    """
+    This function summarises a clone_merge_table() as the number of
+    leading nodes left in the tree, stacked nodes (leading nodes
+    holding at least one clone) and clones folded into them at every
+    threshold of the table.
+    """
+    position = np.arange(len(table))
+    rows = []
+    for column in table.columns:
+        if column in ("leaf", "merge_height"):
+            continue
+        leader_of = table[column].to_numpy()
+        clones = leader_of != position
+        rows.append({
+            "Threshold": column,
+            "Leading nodes": int((~clones).sum()),
+            "Stacked nodes": int(len(np.unique(leader_of[clones]))),
+            "Clones": int(clones.sum()),
+        })
+    return pd.DataFrame(rows)
+
+
+class CloneCounts:
+    """
+    This class holds the clone counts of the stacked nodes (leading
+    leaves holding at least one clone) as integer arrays, with SeqTypes
+    coded by their position in types:
+    other - clones of every SeqType other than the leading leaf's own
+    alternate - clones of another Classification, by SeqType
+    Leading leaves without clones have no row and read as zeros.
+    """
+
+    def __init__(self, types, names, other, alternate):
+        self.types = list(types)
+        self.code = _seqtype_codes(self.types)
+        self.rows = {name: i for i, name in enumerate(names)}
+        self.other = other
+        self.alternate = alternate
+        self._zeros = np.zeros(len(self.types), dtype=other.dtype)
+
+    def other_counts(self, name):
+        """
+        This function returns the counts of clones of other SeqTypes
+        stacked onto the leaf called name.
+        """
+        row = self.rows.get(name)
+        return self._zeros if row is None else self.other[row]
+
+    def alternate_counts(self, name):
+        """
+        This function returns the counts of clones of another
+        Classification, by SeqType, stacked onto the leaf called name.
+        """
+        row = self.rows.get(name)
+        return self._zeros if row is None else self.alternate[row]
+
+
+def tally_clone_groups(names, leader_of, seqtype, classification, types):
+    """
+    This function tallies the clones of every leading leaf from the
+    SeqType codes (positions in types) and Classification codes of the
+    leaves, all given in iter_leaves() order.
+    It returns the Weight of every leaf, counting the clones of the same
+    SeqType for leading leaves (-1 for clones), and the clones of other
+    SeqTypes or of another Classification as CloneCounts.
+    It never measures distances, so a parser change only reruns this.
+    """
+    leader_of = np.asarray(leader_of, dtype=np.int64)
+    position = np.arange(len(leader_of))
+    is_clone = leader_of != position
+    clones = position[is_clone]
+    clone_leaders = leader_of[is_clone]
+
+    # a SeqType listed twice counts under its first position
+    first = _seqtype_codes(types)
+    codes = np.array([first[seqtype] for seqtype in types], dtype=np.int64)[np.asarray(seqtype, dtype=np.int64)]
+    classification = np.asarray(classification)
+    alternate = classification[clones] != classification[clone_leaders]
+    same_type = codes[clones] == codes[clone_leaders]
+
+    # same SeqType adds to the weight of the leading leaf
+    weight = np.bincount(clone_leaders[same_type], minlength=len(leader_of))
+    weight[is_clone] = -1
+
+    # rows only for stacked nodes, other SeqTypes and mixed
+    # classification (intact/defect) are counted by SeqType code
+    stacked, row_of = np.unique(clone_leaders, return_inverse=True)
+    other = np.zeros((len(stacked), len(types)), dtype=np.int64)
+    np.add.at(other, (row_of[~same_type], codes[clones][~same_type]), 1)
+    mixed = np.zeros((len(stacked), len(types)), dtype=np.int64)
+    np.add.at(mixed, (row_of[alternate], codes[clones][alternate]), 1)
+    return weight, CloneCounts(types, [names[i] for i in stacked], other, mixed)
+
+
+def _seqtype_codes(types):
+    """
+    This function maps every SeqType to its position in types (the
+    first one if a SeqType is listed twice).
+    """
+    code = {}
+    for i, seqtype in enumerate(types):
+        code.setdefault(seqtype, i)
+    return code
+
+
+def _greedy_clone_pass(t, thresholds, workers=None):
+    """
+    This function runs the greedy clone pass for several ascending
+    thresholds at once and returns one list of leading leaf positions
+    per threshold.
+    Every leaf searches its surroundings a single time, out to the
+    largest threshold at which it is still a leading leaf.
+    With workers, the independent clades of the tree are searched in a
+    process pool, see _parallel_clone_pass().
+    """
+    search = _CloneSearch(t)
+    if workers is not None and workers > 1:
+        columns = _parallel_clone_pass(search, thresholds, workers)
+        if columns is not None:
+            return columns
+    positions = list(range(len(search.leaves)))
+    return [list(column) for column in search.run(thresholds, positions)]
+
+
+class _CloneSearch:
+    """
+    This class holds the tree as lists (and the shortest path from every
+    node down to one of its leaves) for the greedy clone pass, which can
+    be run on all leaves or on a set of leaves no other leaf is close to.
+    """
+
+    def __init__(self, t):
+        self.parent = t.parent.tolist()
+        self.children = t.children_lists()
+        self.dist = t.dist.tolist()
+        self.leaves = t.leaves.tolist()
+        self.leaf_position = {node: k for k, node in enumerate(self.leaves)}
+
+        # shortest path from every node down to a leaf of its own clade
+        self.below = [0.0] * len(self.parent)
+        for i in reversed(range(len(self.parent))):
+            if self.children[i]:
+                self.below[i] = min(self.dist[c] + self.below[c] for c in self.children[i])
+
+        # clades can only be pruned on distance when no branch is negative
+        self.prune = not (self.dist and min(self.dist) < 0)
+
+    def run(self, thresholds, positions):
+        """
+        This function runs the greedy pass over the leaves at positions
+        (ascending) and returns, per threshold, the leading leaf position
+        of each of them.
+        """
+        index = {k: i for i, k in enumerate(positions)}
+        columns = [[-1] * len(positions) for _ in thresholds]
+        for i, k in enumerate(positions):
+            # thresholds at which this leaf has not been claimed yet
+            open_levels = [j for j, leader_of in enumerate(columns) if leader_of[i] == -1]
+            if not open_levels:
+                continue
+            for j in open_levels:
+                columns[j][i] = k
+            radius = thresholds[open_levels[-1]]
+            bound = radius + abs(radius) * PRUNE_SLACK if self.prune else math.inf
+            for other, ancestor, up_path in _nearby_leaves(self.leaves[k], self.parent, self.children,
+                                                           self.dist, self.below, bound):
+                other_i = index.get(self.leaf_position[other])
+                if other_i is None:
+                    continue  # outside of the leaves searched, never a clone
+                distance = None
+                for j in open_levels:
+                    if columns[j][other_i] != -1:
+                        continue
+                    if distance is None:
+                        distance = _path_distance(other, ancestor, up_path, self.parent, self.dist)
+                    if distance <= thresholds[j]:
+                        columns[j][other_i] = k
+        return columns
+
+
+def _parallel_clone_pass(search, thresholds, workers):
+    """
+    This function runs the greedy clone pass in a process pool. The path
+    between two leaves on either side of a branch longer than the largest
+    threshold is longer than the threshold too (when no branch is
+    negative), so cutting those branches splits the leaves into clades
+    that are searched independently. Each clade keeps the leaf order of
+    the whole tree, so the merged result is the single process one.
+    It returns None when the tree does not split.
+    """
+    if not search.prune:
+        return None
+    # every node points to the top of its clade (the node below the nearest
+    # long branch above it), found by pointer jumping
+    parent = np.asarray(search.parent)
+    top = np.where(np.asarray(search.dist) > max(thresholds), np.arange(len(parent)), parent)
+    top[0] = 0
+    while True:
+        jumped = top[top]
+        if np.array_equal(jumped, top):
+            break
+        top = jumped
+    component = top[search.leaves]
+    order = np.argsort(component, kind="stable")
+    starts = np.flatnonzero(np.r_[True, component[order][1:] != component[order][:-1]])
+    groups = np.split(order, starts[1:])
+    if len(groups) < 2:
+        return None
+
+    # clades are packed into a few tasks per worker, largest first
+    tasks = [[] for _ in range(min(len(groups), workers * TASKS_PER_WORKER))]
+    load = [0] * len(tasks)
+    for positions in sorted(groups, key=lambda positions: (-len(positions), positions[0])):
+        smallest = load.index(min(load))
+        tasks[smallest].append(positions)
+        load[smallest] += len(positions)
+    tasks = [np.sort(np.concatenate(task)).tolist() for task in tasks]
+
+    columns = np.full((len(thresholds), len(search.leaves)), -1, dtype=np.int64)
+    # forking is cheap but only safe from a single threaded process, and
+    # threading only counts Python threads, not those of Qt
+    method = START_METHOD
+    if method is None:
+        method = "fork" if threading.active_count() == 1 and os.name == "posix" else "spawn"
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method),
+                             initializer=_start_worker, initargs=(search,)) as pool:
+        for positions, found in zip(tasks, pool.map(_run_task, [(thresholds, task) for task in tasks])):
+            columns[:, positions] = found
+    return [column.tolist() for column in columns]
+
+
+_worker_search = None
+
+
+def _start_worker(search):
+    """
+    This function keeps the prepared tree in every process of the pool.
+    """
+    global _worker_search
+    _worker_search = search
+
+
+def _run_task(task):
+    thresholds, positions = task
+    return _worker_search.run(thresholds, positions)
+
+
+def _nearby_leaves(leaf, parent, children, dist, below, bound):
+    """
+    This function yields every other leaf that may lie within bound of
+    leaf, with their common ancestor and the branch lengths walked up
+    from leaf to that ancestor.
+    It climbs towards the root and only descends into sister clades
+    whose closest leaf is still within bound.
+    """
+    up_path = []
+    d_up = 0.0
+    node = leaf
+    while parent[node] != -1:
+        d_up += dist[node]
+        if d_up > bound:
+            break
+        up_path.append(dist[node])
+        ancestor = parent[node]
+        for sister in children[ancestor]:
+            if sister == node:
+                continue
+            stack = [(sister, d_up + dist[sister])]
+            while stack:
+                current, d = stack.pop()
+                if d + below[current] > bound:
+                    continue  # every leaf of this clade is too far
+                if children[current]:
+                    for child in children[current]:
+                        stack.append((child, d + dist[child]))
+                else:
+                    yield current, ancestor, up_path
+        node = ancestor
+
+
+def _path_distance(other, ancestor, up_path, parent, dist):
+    """
+    This function returns the distance between two leaves summed in the
+    same order as ete3's get_distance, so that leaves sitting exactly on
+    the threshold are treated the same way as before.
+    """
+    distance = 0.0
+    node = other
+    while node != ancestor:
+        distance += dist[node]
+        node = parent[node]
+    for branch in up_path:
+        distance += branch
+    return distance
@@ -0,0 +1,221 @@
+"""
+distance_index.py
+    This python file contains an index that answers leaf to
+    leaf distance queries on a tree in constant time, using
+    an Euler tour of the tree, a sparse table over it to find
+    lowest common ancestors, and the distance of every node
+    from the root.
+    It is used to export within-clone and nearest neighbour
+    distances for every stacked node.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import numpy as np
+import pandas as pd
+
+
+class DistanceIndex:
+    """
+    This class is built once per (rooted) tree. Nodes are referred to by
+    their preorder index and leaves by their position in iter_leaves()
+    order, as in clone_detection.
+    """
+
+    def __init__(self, parent, children, dist):
+        n = len(parent)
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.leaves = np.array([i for i in range(n) if not children[i]], dtype=np.int64)
+
+        # distance from the root and depth (in nodes) of every node,
+        # parents always come before their children in preorder
+        self.root_dist = np.zeros(n)
+        depth = np.zeros(n, dtype=np.int64)
+        for i in range(1, n):
+            self.root_dist[i] = self.root_dist[parent[i]] + dist[i]
+            depth[i] = depth[parent[i]] + 1
+
+        # Euler tour: a node is written when first reached and again
+        # after each of its children
+        euler = []
+        first = np.zeros(n, dtype=np.int64)
+        stack = [(0, 0)]
+        while stack:
+            node, next_child = stack.pop()
+            if next_child == 0:
+                first[node] = len(euler)
+            euler.append(node)
+            if next_child < len(children[node]):
+                stack.append((node, next_child + 1))
+                stack.append((children[node][next_child], 0))
+        self.euler = np.asarray(euler, dtype=np.int64)
+        self.first = first
+
+        # sparse table: level k holds the shallowest node of every
+        # window of 2**k consecutive Euler tour entries
+        euler_depth = depth[self.euler]
+        self.table = [np.arange(len(euler), dtype=np.int64)]
+        width = 1
+        while 2 * width <= len(euler):
+            previous = self.table[-1]
+            left = previous[:len(previous) - width]
+            right = previous[width:]
+            self.table.append(np.where(euler_depth[left] <= euler_depth[right], left, right))
+            width *= 2
+        self.euler_depth = euler_depth
+
+    @classmethod
+    def from_tree(cls, t):
+        """
+        This function builds the index for an ArrayTree.
+        """
+        return cls(t.parent.tolist(), t.children_lists(), t.dist.tolist())
+
+    def lca(self, a, b):
+        """
+        This function returns the lowest common ancestor of nodes a and
+        b. Both may be scalars or equally shaped arrays of node indices.
+        """
+        left = np.minimum(self.first[a], self.first[b])
+        right = np.maximum(self.first[a], self.first[b])
+        level = np.floor(np.log2(right - left + 1)).astype(np.int64)
+        if np.ndim(level) == 0:
+            table = self.table[level]
+            i, j = table[left], table[right - (1 << level) + 1]
+            return self.euler[i if self.euler_depth[i] <= self.euler_depth[j] else j]
+        i = np.empty_like(left)
+        j = np.empty_like(left)
+        for k in np.unique(level):
+            at = level == k
+            i[at] = self.table[k][left[at]]
+            j[at] = self.table[k][right[at] - (1 << k) + 1]
+        return self.euler[np.where(self.euler_depth[i] <= self.euler_depth[j], i, j)]
+
+    def distance(self, a, b):
+        """
+        This function returns the branch length distance between nodes
+        a and b (scalars or arrays of node indices).
+        """
+        return self.root_dist[a] + self.root_dist[b] - 2 * self.root_dist[self.lca(a, b)]
+
+    def leaf_distance(self, i, j):
+        """
+        This function returns the distance between the leaves at
+        positions i and j of iter_leaves() order (scalars or arrays).
+        """
+        return self.distance(self.leaves[i], self.leaves[j])
+
+
+def clone_distance_table(index, names, leader_of):
+    """
+    This function returns a DataFrame with a row for every stacked node
+    (a leading leaf holding at least one clone): the size of the clone,
+    the mean and largest distance of its clones to the leading leaf,
+    the largest distance between any two of its members, and the
+    closest leaf outside of the clone.
+    names and leader_of are given in iter_leaves() order.
+    """
+    leader_of = np.asarray(leader_of)
+    position = np.arange(len(leader_of))
+    members = {}
+    for i in position[leader_of != position]:
+        members.setdefault(leader_of[i], [leader_of[i]]).append(i)
+    nearest, nearest_dist = _nearest_other_clone(index, leader_of)
+
+    rows = []
+    for leader, clone in members.items():
+        clone = np.asarray(clone)
+        to_leader = index.leaf_distance(np.full(len(clone) - 1, leader), clone[1:])
+        # the two ends of a clone's longest path are found with two
+        # sweeps, the farthest member from any member is one of them
+        end = clone[np.argmax(index.leaf_distance(np.full(len(clone), leader), clone))]
+        diameter = index.leaf_distance(np.full(len(clone), end), clone).max()
+        rows.append({
+            "Leading node": names[leader],
+            "Clone size": len(clone),
+            "Mean distance to leading node": to_leader.mean(),
+            "Max distance to leading node": to_leader.max(),
+            "Clone diameter": diameter,
+            "Nearest neighbour": names[nearest[leader]] if nearest[leader] >= 0 else "",
+            "Nearest neighbour distance": nearest_dist[leader],
+        })
+    return pd.DataFrame(rows, columns=["Leading node", "Clone size", "Mean distance to leading node",
+                                       "Max distance to leading node", "Clone diameter",
+                                       "Nearest neighbour", "Nearest neighbour distance"])
+
+
+def _nearest_other_clone(index, leader_of):
+    """
+    This function returns, for every leaf position, the closest leaf
+    belonging to another clone and the distance to it (-1 and NaN if the
+    tree holds a single clone).
+    It keeps the two closest leaves of distinct clones below and above
+    every node, so it takes one pass down and one pass up the tree.
+    """
+    n = len(index.parent)
+    leaf_at = {node: k for k, node in enumerate(index.leaves.tolist())}
+    children = [[] for _ in range(n)]
+    for node in range(1, n):
+        children[index.parent[node]].append(node)
+    branch = np.zeros(n)
+    branch[1:] = index.root_dist[1:] - index.root_dist[index.parent[1:]]
+
+    # best (distance, clone, leaf) entries inside every clade
+    down = [None] * n
+    for node in reversed(range(n)):
+        if not children[node]:
+            k = leaf_at[node]
+            down[node] = [(0.0, leader_of[k], k)]
+        else:
+            entries = []
+            for child in children[node]:
+                entries = _best_two(entries, _shift(down[child], branch[child]))
+            down[node] = entries
+
+    # best entries outside of every clade, measured from its root
+    up = [[] for _ in range(n)]
+    for node in range(n):
+        kids = children[node]
+        if not kids:
+            continue
+        shifted = [_shift(down[child], branch[child]) for child in kids]
+        prefix = [[]]
+        for entries in shifted[:-1]:
+            prefix.append(_best_two(prefix[-1], entries))
+        suffix = []
+        for i in reversed(range(len(kids))):
+            suffix.append([] if i == len(kids) - 1 else _best_two(suffix[-1], shifted[i + 1]))
+        suffix.reverse()
+        for i, child in enumerate(kids):
+            outside = _best_two(up[node], _best_two(prefix[i], suffix[i]))
+            up[child] = _shift(outside, branch[child])
+
+    nearest = np.full(len(leader_of), -1)
+    nearest_dist = np.full(len(leader_of), np.nan)
+    for node, k in leaf_at.items():
+        for distance, clone, other in up[node]:
+            if clone != leader_of[k]:
+                nearest[k] = other
+                nearest_dist[k] = index.leaf_distance(k, other)
+                break
+    return nearest, nearest_dist
+
+
+def _shift(entries, length):
+    """
+    This function adds a branch length to every (distance, clone, leaf) entry.
+    """
+    return [(distance + length, clone, leaf) for distance, clone, leaf in entries]
+
+
+def _best_two(a, b):
+    """
+    This function merges two lists of (distance, clone, leaf) entries,
+    keeping the closest entry of the two closest distinct clones.
+    """
+    best = []
+    for entry in sorted(a + b):
+        if not best or best[0][1] != entry[1]:
+            best.append(entry)
+            if len(best) == 2:
+                break
+    return best
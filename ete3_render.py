@@ -0,0 +1,333 @@
+"""
+ete3_render.py
+    This python file contains the ete3 (PyQt5) drawing of the
+    tree, the renderer used before svg_render.py. It takes the
+    same inputs as svg_render.render_svg() and is only imported
+    when it is asked for, so Qt is not started otherwise.
+    The SVG ete3 writes is then streamed through lxml to draw
+    the custom node shapes.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import os
+from contextlib import ExitStack
+os.environ['QT_QPA_PLATFORM']='offscreen'
+from lxml import etree
+
+from ete3 import TreeStyle, TextFace, NodeStyle
+from ete3 import faces, CircleFace, RectFace
+from ete3.treeview.faces import _SphereItem, _RectItem
+from ete3.treeview.qt import QGraphicsItem, QGraphicsRectItem, QGraphicsSimpleTextItem, QFont
+from ete3.treeview.qt import QGraphicsPolygonItem, QPolygonF, QPointF, QBrush, QPen, QColor
+
+from stack_layout import CIRCLE, STACK_GLYPH_SIZE
+from clade_detail import wedge_size, WEDGE_COLOR
+from svg_render import shape_points
+
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+
+
+def render_ete3(t, leaf_types, leaf_square, stacks, legend, class_legend, shapes, scale, show_leaf_names,
+                svg_file, wedges=None):
+    """
+    This function draws the tree t with ete3 into svg_file. The
+    arguments are the ones of svg_render.render_svg().
+    """
+    colors = [color for label, color in legend]
+    leaf_colors = [colors[k] if k >= 0 else "black" for k in leaf_types]
+    leaf_square = list(leaf_square)
+    wedges = [None] * len(leaf_square) if wedges is None else wedges
+    t = t.to_ete()
+    leaves = list(t.iter_leaves())
+
+    # Setting node style
+    def make_branches_bigger(node, new_size):
+        node.img_style["size"] = 0
+        node.img_style["hz_line_width"] = new_size # Change the horizotal lines stroke size
+        node.img_style["vt_line_width"] = new_size # Change the vertical lines stroke size
+    for node in t.traverse():
+        for c in node.children:
+            make_branches_bigger(c, 2)
+    leaf_wedges = {}
+    for leaf, color, square, wedge in zip(leaves, leaf_colors, leaf_square, wedges):
+        nstyle = NodeStyle()
+        if square:
+            nstyle["shape"] = "square"
+        nstyle["fgcolor"] = color
+        nstyle["size"] = 6 if square else 8
+        nstyle["hz_line_width"] = 2
+        if wedge is not None:  # the wedge is drawn instead of the ball
+            nstyle["size"] = 0
+            leaf_wedges[leaf] = WedgeFace(*wedge_size(*wedge, scale))
+        leaf.set_style(nstyle)
+
+    # one face per distinct stack
+    stack_faces = {}
+    leaf_stacks = {}
+    for leaf, glyphs in zip(leaves, stacks):
+        if not glyphs:
+            continue
+        if glyphs not in stack_faces:
+            stack_faces[glyphs] = StackFace(tuple((shape, colors[k], count) for shape, k, count in glyphs))
+        leaf_stacks[leaf] = stack_faces[glyphs]
+
+    # plotting entire tree
+    ts = TreeStyle()
+
+    def custom_layout(node):
+        """
+        This function attaches the planned face stacking the clonal sequences
+        """
+        if node in leaf_wedges:
+            faces.add_face_to_node(leaf_wedges[node], node, column=0, position="branch-right")
+        if node in leaf_stacks:
+            faces.add_face_to_node(leaf_stacks[node], node, column=1, position="branch-right")
+
+    ts.layout_fn = custom_layout
+
+    ts.margin_left = 20
+    ts.margin_right = 20
+    ts.margin_top = 20
+
+    # Setting root node
+    rootstyle = NodeStyle()
+    rootstyle["size"] = 3
+    rootstyle["fgcolor"] = 'black'
+    rootstyle["shape"] = "square"
+    rootstyle["vt_line_width"] = 2
+    rootstyle["hz_line_width"] = 2
+    t.set_style(rootstyle)
+
+    # LEGEND INFORMATION
+
+    # add padding around legend
+    ts.legend.add_face(TextFace(f"", fsize=20, ftype='Arial'), column=0)
+    ts.legend.add_face(TextFace(f"                    ", fsize=20, ftype='Arial'), column=1)
+    ts.legend.add_face(TextFace(f"", fsize=20, ftype='Arial'), column=2)
+    ts.legend.add_face(TextFace(f"                    ", fsize=20, ftype='Arial'), column=3)
+    ts.legend.add_face(TextFace(f"", fsize=20, ftype='Arial'), column=4)
+    ts.legend.add_face(TextFace(f"                    ", fsize=20, ftype='Arial'), column=5)
+
+    for key, val in legend:
+        if key:  # for unmapped sequences, don't populate legend
+            ts.legend.add_face(TextFace(f" {key} ", fsize=12, ftype='Arial'), column=1)
+            ts.legend.add_face(CircleFace(3, val), column=0)
+        else:
+            ts.legend.add_face(TextFace(f" Undefined Sequence ", fsize=12, ftype='Arial'), column=1)
+            ts.legend.add_face(CircleFace(3, val), column=0)
+    ts.legend_position = 2
+
+    if class_legend is not None:
+        classification_alternate, classification_default = class_legend
+        ts.legend.add_face(TextFace(f" {classification_alternate}", fsize=12, ftype='Arial'), column=3)
+        ts.legend.add_face(RectFace(8,8,"black", "white"), column=2)
+        ts.legend.add_face(TextFace(f" {classification_default}", fsize=12, ftype='Arial'), column=3)
+        ts.legend.add_face(CircleFace(3,"black"), column=2)
+
+    # more space between branches
+    ts.branch_vertical_margin = 2
+    ts.scale = scale # def = 10000
+    ts.show_leaf_name = show_leaf_names # def = False
+
+    # ete3 writes to a scratch file that is rewritten into svg_file
+    raw_file = f"{os.path.splitext(svg_file)[0]}-ete3.svg"
+    t.render(raw_file, tree_style=ts, w=4, dpi=200, units='in')
+    try:
+        rewrite_svg(raw_file, svg_file, shapes)
+    finally:
+        os.remove(raw_file)
+
+
+def rewrite_svg(raw_file, svg_file, shapes):
+    """
+    This function copies the SVG written by ete3 from raw_file to svg_file,
+    drawing the circles whose fill is a key of shapes as the shape it maps
+    to and setting the font of every text to Arial.
+    The SVG is streamed: ete3 puts every node, line and face in its own
+    group under a single top group, and each of those groups is rewritten
+    and written out as soon as it has been read, so the whole document is
+    never held in memory.
+    """
+    # color -> shape lookup, circles are left as they are
+    new_shapes = {color: shape for color, shape in shapes.items() if shape.lower() != 'circle'}
+    depth = 0
+    with etree.xmlfile(svg_file, encoding="utf-8") as xf, ExitStack() as open_elements:
+        for event, elem in etree.iterparse(raw_file, events=("start", "end"), huge_tree=True):
+            if event == "start":
+                depth += 1
+                # the svg element and its top group are opened around the stream
+                if depth == 1:
+                    # the xml prefix is declared so xmlfile writes the xml:space of texts with it
+                    nsmap = dict(elem.nsmap, xml=XML_NAMESPACE)
+                    open_elements.enter_context(xf.element(elem.tag, elem.attrib, nsmap=nsmap))
+                elif depth == 2 and etree.QName(elem).localname == "g":
+                    open_elements.enter_context(xf.element(elem.tag, elem.attrib))
+                continue
+            depth -= 1
+            if depth == 0 or (depth == 1 and etree.QName(elem).localname == "g"):
+                continue  # closed when the stream ends
+            if depth > 2:
+                continue  # written with its group
+            fix_group(elem, new_shapes)
+            write_element(xf, elem)
+            # free what was written
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def write_element(xf, elem):
+    """
+    This function writes elem and its children to the lxml xmlfile xf.
+    Unlike xf.write(), it does not declare the namespaces of the SVG
+    again on every group.
+    """
+    with xf.element(elem.tag, elem.attrib):
+        if elem.text:
+            xf.write(elem.text)
+        for child in elem:
+            write_element(xf, child)
+            if child.tail:
+                xf.write(child.tail)
+
+
+def fix_group(group, new_shapes):
+    """
+    This function replaces the circles of group that have a fill in
+    new_shapes with that shape, and sets the font of its texts to Arial.
+    """
+    for circle in list(group.iter("{*}circle")):
+        parent = circle.getparent()
+
+        # check parent fill instead of circle
+        fill = parent.get("fill", "").upper()
+        if fill in new_shapes:
+            # get parent values for stroke width and stroke
+            stroke = parent.get("stroke", "none")
+            stroke_width = parent.get("stroke-width", "1")
+            new_shape = replace_shape(circle, new_shapes[fill], fill, stroke, stroke_width)
+            new_shape.tail = circle.tail
+            parent.replace(circle, new_shape)
+    for text_elem in group.iter("{*}text"):
+        text_elem.set("font-family", "Arial")
+
+
+class StackFace(faces.Face):
+    """
+    This class draws the whole stack of a leading node as a single item:
+    a row of circles and squares given as (shape, color, count), where a
+    glyph with a count above one is followed by a "× N" label.
+    Identical stacks share one face. ete3 sizes the faces of every node
+    before drawing any of them, so the Qt item is made each time the face
+    is drawn instead of kept on the face.
+    """
+
+    def __init__(self, glyphs):
+        faces.Face.__init__(self)
+        self.type = "item"
+        self.rotable = False
+        self.glyphs = glyphs
+        self.font = QFont("Arial", 8)
+        self.extent = None  # (width, height, label widths), known once Qt is running
+
+    def update_items(self):
+        pass
+
+    @property
+    def item(self):
+        width, height, label_widths = self._extent()
+        item = QGraphicsRectItem(0, 0, width, height)
+        item.setFlag(QGraphicsItem.ItemHasNoContents)  # only holds the glyphs
+        x = 0
+        for (shape, color, count), label_width in zip(self.glyphs, label_widths):
+            if shape == CIRCLE:
+                glyph = _SphereItem(STACK_GLYPH_SIZE / 2, color, solid=True)
+            else:
+                glyph = _RectItem(STACK_GLYPH_SIZE, STACK_GLYPH_SIZE, color, 'white')
+            glyph.setParentItem(item)
+            glyph.setPos(x, (height - STACK_GLYPH_SIZE) / 2)
+            x += STACK_GLYPH_SIZE
+            if count > 1:
+                label = QGraphicsSimpleTextItem(f"×{count}")
+                label.setFont(self.font)
+                label.setParentItem(item)
+                label.setPos(x + 2, (height - label.boundingRect().height()) / 2)
+                x += label_width + 6
+        return item
+
+    def _extent(self):
+        if self.extent is None:
+            label_widths = []
+            height = STACK_GLYPH_SIZE
+            for shape, color, count in self.glyphs:
+                if count > 1:
+                    label = QGraphicsSimpleTextItem(f"×{count}")
+                    label.setFont(self.font)
+                    label_widths.append(label.boundingRect().width())
+                    height = max(height, label.boundingRect().height())
+                else:
+                    label_widths.append(0)
+            width = STACK_GLYPH_SIZE * len(self.glyphs) + sum(w + 6 for w in label_widths if w)
+            self.extent = (width, height, label_widths)
+        return self.extent
+
+    def _width(self):
+        return self._extent()[0]
+
+    def _height(self):
+        return self._extent()[1]
+
+
+class WedgeFace(faces.Face):
+    """
+    This class draws the wedge that stands for a clade cut off by the
+    level of detail, width wide and height high, pointing at its node.
+    """
+
+    def __init__(self, width, height):
+        faces.Face.__init__(self)
+        self.type = "item"
+        self.rotable = False
+        self.width = width
+        self.height = height
+
+    def update_items(self):
+        pass
+
+    @property
+    def item(self):
+        item = QGraphicsPolygonItem(QPolygonF([QPointF(0, self.height / 2), QPointF(self.width, 0),
+                                               QPointF(self.width, self.height)]))
+        item.setBrush(QBrush(QColor(WEDGE_COLOR)))
+        item.setPen(QPen(QColor("black")))
+        return item
+
+    def _width(self):
+        return self.width
+
+    def _height(self):
+        return self.height
+
+
+def replace_shape(circle, shape, fill, stroke, stroke_width):
+    """
+    This function takes in values for circles to replace with a new
+    shape. It takes in circle values including a specific fill color
+    to replace with a new shape.
+    Shapes are defined as either 'triangle', 'diamond', 'pentagon' or
+    'square' (see svg_render.shape_points()).
+    It uses the parent stroke and stroke width to match new shape to existing
+    nodes.
+    """
+    # get circle values
+    cx = float(circle.get("cx"))
+    cy = float(circle.get("cy"))
+    r = float(circle.get("r"))
+
+    points = [f"{x},{y}" for x, y in shape_points(shape, cx, cy, r)]
+    return etree.Element("polygon", {
+        "points": " ".join(points),
+        "fill": fill,
+        "stroke": stroke,
+        "stroke-width": stroke_width
+    })
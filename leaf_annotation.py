@@ -0,0 +1,112 @@
+"""
+leaf_annotation.py
+    This python file contains the matching engine used to
+    annotate leaves from their names with the parser tables.
+    The parser strings of a table are compiled once, and
+    every distinct leaf name is matched against them a single
+    time. The first row of the table that matches a name
+    wins, as it always has.
+    Trees annotated with NHX tags can instead be read from
+    their SeqType and Class tags, without any name parsing.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import re
+from functools import lru_cache
+
+import numpy as np
+
+# NHX tags read in the NHX annotation mode, [&&NHX:SeqType=...:Class=...]
+NHX_SEQTYPE = "SeqType"
+NHX_CLASS = "Class"
+# parser strings without these characters are plain substrings
+REGEX_SYNTAX = set(".^$*+?{}[]\\|()")
+
+
+class ParserMatcher:
+    """
+    This class matches leaf names against the parser strings of a table
+    (in table order). Build it with compile_parser() so tables that did
+    not change are not compiled again.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
+        self.compiled = [re.compile(pattern) for pattern in self.patterns]
+        # when every row is a plain substring, one pattern of all of them
+        # finds the names no row matches, which skip the row by row search
+        self.prefilter = None
+        if self.patterns and not any(REGEX_SYNTAX & set(pattern) for pattern in self.patterns):
+            self.prefilter = re.compile("|".join(re.escape(pattern) for pattern in self.patterns))
+
+    def match_name(self, name):
+        """
+        This function returns the index of the first parser row found in
+        name, or -1 if no row matches.
+        """
+        if self.prefilter is not None and not self.prefilter.search(name):
+            return -1
+        for i, pattern in enumerate(self.compiled):
+            if pattern.search(name):
+                return i
+        return -1
+
+    def match(self, names):
+        """
+        This function returns a numpy array with the index of the first
+        matching parser row (-1 for no match) for every name. Repeated
+        names are only matched once.
+        """
+        codes = {}
+        for name in names:
+            if name not in codes:
+                codes[name] = self.match_name(name)
+        return np.fromiter((codes[name] for name in names), dtype=np.int64, count=len(names))
+
+
+@lru_cache(maxsize=32)
+def compile_parser(patterns):
+    """
+    This function returns the ParserMatcher for a tuple of parser
+    strings, reusing the one compiled for an identical table.
+    """
+    return ParserMatcher(patterns)
+
+
+def match_seqtypes(names, parser_df):
+    """
+    This function returns, for every name, the row of the parser table
+    that gives its SeqType (-1 for names that match no row).
+    """
+    matcher = compile_parser(tuple(str(parser) for parser in parser_df["Parser"]))
+    return matcher.match(names)
+
+
+def match_classifications(names, class_parser):
+    """
+    This function returns, for every name, 1 if class_parser is found
+    in it (the alternate classification) and 0 otherwise (the default one).
+    """
+    matcher = compile_parser((str(class_parser),))
+    return (matcher.match(names) == 0).astype(np.int8)
+
+
+def match_seqtype_tags(tags, parser_df):
+    """
+    This function returns, for every NHX SeqType tag, the first row of
+    the parser table with that SeqType (-1 for missing or unknown tags).
+    Only the SeqType, Color and Shape columns of the table are used.
+    """
+    rows = {}
+    for i, seqtype in enumerate(parser_df["SeqType"]):
+        rows.setdefault(str(seqtype), i)
+    return np.fromiter((rows.get(tag, -1) for tag in tags), dtype=np.int64, count=len(tags))
+
+
+def match_class_tags(tags, classification_alternate):
+    """
+    This function returns, for every NHX Class tag, 1 if it is the
+    alternate classification and 0 otherwise (the default one).
+    """
+    alternate = str(classification_alternate)
+    return np.fromiter((tag == alternate for tag in tags), dtype=np.int8, count=len(tags))
@@ -0,0 +1,239 @@
+"""
+newick_reader.py
+    This python file contains the tree reader used by the
+    Homepage and tree-render-function.py. It reads a Newick
+    (or NHX) tree in chunks straight from the upload buffer,
+    a file or a pipe, decompressing gzip, bz2 and xz trees
+    on the fly, and builds the ArrayTree in one pass without
+    recursion or a temporary file.
+    Node labels are read with the same rules as ete3's
+    Newick format 0, so trees read the same as with Tree().
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import bz2
+import gzip
+import io
+import lzma
+import os
+import re
+from contextlib import contextmanager
+
+import numpy as np
+
+from array_tree import ArrayTree
+
+CHUNK_SIZE = 1 << 20  # characters read at a time
+
+# file extensions the tree uploader accepts
+TREE_EXTENSIONS = ["tre", "nwk", "tree", "newick", "nhx"]
+COMPRESSED_EXTENSIONS = ["gz", "bz2", "xz"]
+
+# node labels of ete3's Newick format 0: leaf name and length, internal
+# node support and length, each optionally followed by an NHX comment
+_FLOAT = r"\s*[+-]?\d+\.?\d*(?:[eE][-+]?\d+)?\s*"
+_NHX = r"\[&&NHX:[^\]]*\]"
+_LEAF_LABEL = re.compile(r"^\s*([^():,;]+?)\s*(:%s)?\s*(%s)?\s*$" % (_FLOAT, _NHX))
+_INTERNAL_LABEL = re.compile(r"^\s*(%s)?\s*(:%s)?\s*(%s)?\s*$" % (_FLOAT, _FLOAT, _NHX))
+
+_STRUCTURE = re.compile(r"([(),;])")
+_LINE_BREAKS = {ord("\n"): None, ord("\r"): None, ord("\t"): None}
+
+# ete3 gives nodes without a branch length a length of 1, except the root
+DEFAULT_DIST = 1.0
+DEFAULT_SUPPORT = 1.0
+
+
+class NewickError(ValueError):
+    """
+    This class is raised for trees that are not valid Newick.
+    """
+
+
+@contextmanager
+def open_tree_stream(source):
+    """
+    This function opens source (a path, bytes or a binary file object
+    such as sys.stdin.buffer) as text, decompressing gzip, bz2 and xz
+    data, which is recognised from its first bytes rather than its name.
+    File objects passed in are left open.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        raw = open(source, "rb")
+        owned = True
+    else:
+        raw = io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+        owned = False
+    buffered = raw if hasattr(raw, "peek") else io.BufferedReader(raw)
+    magic = buffered.peek(6)[:6]
+    if magic.startswith(b"\x1f\x8b"):
+        stream = gzip.GzipFile(fileobj=buffered)
+    elif magic.startswith(b"BZh"):
+        stream = bz2.BZ2File(buffered)
+    elif magic.startswith(b"\xfd7zXZ\x00"):
+        stream = lzma.LZMAFile(buffered)
+    else:
+        stream = buffered
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    try:
+        yield text
+    finally:
+        text.detach()
+        if stream is not buffered:
+            stream.close()
+        if buffered is not raw:
+            buffered.detach()
+        if owned:
+            raw.close()
+
+
+def read_tree(source, chunk_size=CHUNK_SIZE):
+    """
+    This function reads a Newick tree from source (see
+    open_tree_stream()) and returns it as an ArrayTree.
+    """
+    with open_tree_stream(source) as text:
+        return parse_newick(iter(lambda: text.read(chunk_size), ""))
+
+
+def parse_newick(chunks):
+    """
+    This function builds an ArrayTree from a Newick tree given as an
+    iterable of text chunks, which may split the tree anywhere.
+    Nodes are created in the order they are read, which is preorder.
+    Everything after the closing ';' is ignored.
+    """
+    tree = _TreeBuilder()
+    pending = ""
+    for chunk in chunks:
+        parts = _STRUCTURE.split(chunk.translate(_LINE_BREAKS))
+        parts[0] = pending + parts[0]
+        pending = parts.pop()  # text after the last separator, may continue
+        for label, separator in zip(parts[::2], parts[1::2]):
+            tree.add(label, separator)
+            if tree.done:
+                return tree.finish()
+    if pending.strip() or not tree.started:
+        raise NewickError("Unexisting tree file or Malformed newick tree structure.")
+    raise NewickError("Broken newick structure: missing ';'")
+
+
+class _TreeBuilder:
+    """
+    This class receives the tree one (label, separator) pair at a time,
+    where label is the text read before the separator, and keeps the
+    open clades on a stack.
+    """
+
+    def __init__(self):
+        self.parent = []
+        self.dist = []
+        self.support = []
+        self.name_id = []
+        self.names = [""]
+        self.name_ids = {"": 0}
+        self.features = {}  # NHX tag -> {node: value}
+        self.open = []  # internal nodes whose ')' has not been read yet
+        self.closed = None  # node closed by the last ')'
+        self.previous = None  # last separator read
+        self.started = False
+        self.done = False
+
+    def add(self, label, separator):
+        """
+        This function reads the label in front of one separator.
+        """
+        if self.previous == ")":
+            self._internal_label(self.closed, label)
+        elif separator == "(":
+            if label.strip():
+                raise NewickError(f"Broken newick structure at: {label.strip()[:50]}")
+        elif self.previous is None and separator == ";":
+            self._leaf_label(self._new_node(-1), label)  # a tree of a single leaf
+        else:
+            if not self.open:
+                raise NewickError("Parentheses do not match. Broken tree structure?")
+            self._leaf_label(self._new_node(self.open[-1]), label)
+
+        if separator == "(":
+            if self.previous == ")" or (self.started and not self.open):
+                raise NewickError("Parentheses do not match. Broken tree structure?")
+            self.open.append(self._new_node(self.open[-1] if self.open else -1))
+        elif separator == ")":
+            if not self.open:
+                raise NewickError("Parentheses do not match. Broken tree structure?")
+            self.closed = self.open.pop()
+        elif separator == ";":
+            if self.open:
+                raise NewickError("Parentheses do not match. Broken tree structure?")
+            self.done = True
+        self.previous = separator
+        self.started = True
+
+    def finish(self):
+        """
+        This function returns the ArrayTree that was read.
+        """
+        # nodes were numbered as they were read, which is already preorder,
+        # so the children of a node are its later nodes in reading order
+        parent = np.asarray(self.parent, dtype=np.int64)
+        child_idx = np.argsort(parent[1:], kind="stable") + 1
+        child_ptr = np.concatenate(([0], np.cumsum(np.bincount(parent[1:], minlength=len(parent)))))
+        features = {}
+        for tag, values in self.features.items():
+            features[tag] = np.full(len(parent), None, dtype=object)
+            features[tag][list(values)] = list(values.values())
+        return ArrayTree(parent, child_ptr, child_idx, np.asarray(self.dist, dtype=np.float64),
+                         np.asarray(self.support, dtype=np.float64), np.asarray(self.name_id, dtype=np.int64),
+                         self.names, features=features)
+
+    def _new_node(self, parent):
+        self.parent.append(parent)
+        self.dist.append(DEFAULT_DIST if parent != -1 else 0.0)
+        self.support.append(DEFAULT_SUPPORT)
+        self.name_id.append(0)
+        return len(self.parent) - 1
+
+    def _leaf_label(self, node, label):
+        label = label.strip()
+        if not label:
+            raise NewickError("Empty leaf node found")
+        found = _LEAF_LABEL.match(label)
+        if found is None:
+            raise NewickError(f"Unexpected newick format '{label[:50]}'")
+        name, dist, nhx = found.groups()
+        name = name.strip()
+        if name not in self.name_ids:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        self.name_id[node] = self.name_ids[name]
+        if dist is not None:
+            self.dist[node] = float(dist[1:])
+        if nhx is not None:
+            self._nhx_tags(node, nhx)
+
+    def _internal_label(self, node, label):
+        label = label.strip()
+        if not label:
+            return
+        found = _INTERNAL_LABEL.match(label)
+        if found is None:
+            raise NewickError(f"Unexpected newick format '{label[:50]}'")
+        support, dist, nhx = found.groups()
+        if support is not None:
+            self.support[node] = float(support)
+        if dist is not None:
+            self.dist[node] = float(dist[1:])
+        if nhx is not None:
+            self._nhx_tags(node, nhx)
+
+    def _nhx_tags(self, node, nhx):
+        """
+        This function keeps the name=value fields of an NHX comment.
+        """
+        for field in nhx[len("[&&NHX:"):-1].split(":"):
+            if field.count("=") != 1:
+                raise NewickError(f"Invalid NHX format {field}")
+            tag, value = field.split("=")
+            self.features.setdefault(tag, {})[node] = value
+
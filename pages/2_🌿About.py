@@ -36,7 +36,7 @@ st.markdown("""
 - 🎨 Custom color mapping for sequence types
 - 🔷 Multiple node shapes (circle, square, triangle, diamond, pentagon)
 - 🌿 Adjustable clonality threshold and tree scaling
-- 📊 High-quality SVG image export for publications
+- 📊 High-quality SVG image export for publications (PDF and PNG files can be created from it)
 - 🔒 Data Privacy: no data is stored on the server
 """)
 
@@ -128,7 +128,12 @@ st.markdown("### Step 2: Upload Your Tree File")
 st.markdown("""
 Upload your phylogenetic tree file in one of the supported Newick formats:
 
-**Supported formats:** `.tre`, `.nwk`, `.newick`, `.tree`, `.nhx`
+**Supported formats:** `.tre`, `.nwk`, `.newick`, `.tree`, `.nhx`, also compressed with gzip, bz2 or xz (e.g. `.nwk.gz`)
+
+**NHX annotations:** trees whose leaves carry `[&&NHX:SeqType=...:Class=...]` tags can be annotated
+from the tags instead of the leaf names by turning on "Annotate from NHX tags". The SeqType tag is
+matched to the labels of the parser table (which then only sets colors and shapes) and the Class tag
+to the square classification label.
 
 The tree will be automatically:
 - Rooted at the midpoint (or custom outgroup if specified)
@@ -150,10 +155,37 @@ Fine-tune your tree visualization using the **Tree Settings** section:
 - Lower values = stricter definition of clones (must be more similar)
 - Higher values = more sequences grouped together
 - Default: 1e-06 (~1 mutation difference, though this changes by sequence length used to generate trees)
+- After uploading, the "Stacked nodes vs. clonality threshold" chart shows how many stacked nodes every slider value gives
+
+**Level of detail:** Trees with more leaves than "Draw at most this many leaves" (after clones are stacked) have
+their largest clades drawn as a single wedge, with the number of sequences of every SeqType next to it. Clades
+shallower than the branch length set below it are drawn as wedges as well. Clones are still found on the whole tree.
+Every leaf is drawn by default, and downloaded figures are simplified the same way as the tree shown.
+
+**Search clones in parallel:** Trees with at least 20,000 leaves are split into independent clades that are searched
+on the CPUs the app may use, shared between the trees being drawn. The clones found are the same as without it.
+
+**Draw with ete3:** The tree is written directly as SVG by default. Turn this on to draw it with ete3 (PyQt5)
+as before, which is much slower on large trees.
 
 **Show Node Names:** Toggle to display sequence names for leading nodes
 
 **Tree Outgroup:** Specify a custom root node name (default: midpoint rooting)
+
+**Preview:** While a large tree is being drawn, a preview with a few hundred leaves (without leaf names or legend)
+is shown in its place.
+
+**Cancel drawing:** While a tree is being drawn, the stage it is at (or its place in line, when the server is busy
+with other trees) is shown with a button to cancel it. Trees that take longer than 10 minutes or need more than 4 GB
+of memory to draw are stopped.
+
+**Zoom:** Large trees are shown a view at a time. Move the zoom and position sliders under the tree to look around
+it; only the part in view is sent to the browser. Choose "Whole tree" to show all of it, and download the SVG for the
+full drawing. Trees drawn with ete3 are always shown whole.
+
+**Drill down into a clade:** Once a tree is drawn, enter sequence names separated by commas to draw only the clade
+of their common ancestor. Parts of names, such as a participant or timepoint, pick every sequence with them in their
+name. The clade is drawn from the tree already rooted and searched for clones, so nothing is read or searched again.
 """)
 
 with st.expander("🔷 Binary Shape Classification"):
@@ -208,7 +240,8 @@ with col2:
     - **Diamond**
     - **Pentagon**
 
-    Shapes are mapped to colors via the parser table.
+    Shapes are mapped to colors via the parser table. Editing only the
+    colors or shapes recolors the tree already drawn instead of drawing it again.
     """)
 
 st.markdown("### Clone Stacking")
@@ -218,13 +251,24 @@ are within the clonality threshold distance of each other and share the same seq
 they are collapsed into a single node with stacked symbols representing each clone.
 
 **How it works:**
-1. The tool calculates pairwise distances between all leaf nodes
+1. Each leading node searches the nearby clades of the tree for leaves within the threshold distance
 2. Sequences within the threshold distance are identified as clones
 3. Clones of the same type are visually stacked at a single node
 4. Different sequence types can also be stacked together if they're clonal
 
 The leading node (first sequence in each clone group) is kept, and its name is shown
 if "Show Node Names" is enabled.
+
+Stacks with more clones than the "Summarize stacks" setting (default 50) are drawn with one symbol per
+sequence type and shape followed by its count (e.g. `● ×120`), which keeps large clones readable.
+
+The distances inside every clone (to the leading node and across the clone) and to the closest
+sequence outside of it can be downloaded as a CSV next to the tree.
+
+**Alignment-based clones:** if a FASTA alignment of the sequences (`.fasta`, `.fa`, `.fas`, `.fna`, `.aln`,
+optionally compressed) is uploaded next to the tree, clones are instead sequences that differ by at most
+the clonality mismatch threshold (gaps and ambiguous bases are not counted). Each leading node is compared
+with the sequences of its surrounding clade (up to 128 leaves), and clones are stacked the same way.
 """)
 
 # Divider
@@ -256,7 +300,7 @@ st.markdown("## Troubleshooting & FAQ")
 
 with st.expander("❓ My tree isn't rendering. What should I check?"):
     st.markdown("""
-    1. **File format**: Ensure your file has one of these extensions: `.tre`, `.nwk`, `.newick`, `.tree`, `.nhx`
+    1. **File format**: Ensure your file has one of these extensions: `.tre`, `.nwk`, `.newick`, `.tree`, `.nhx` (or `.gz`, `.bz2`, `.xz` for compressed trees)
     2. **Valid Newick format**: Check that your tree file is properly formatted
     3. **Parser table**: Make sure there are no empty cells in the parser table
     4. **File size**: Very large trees may take longer to process
@@ -302,13 +346,15 @@ with st.expander("❓ What's the difference between the shape options?"):
 
 with st.expander("❓ How many sequences can Koalafy handle?"):
     st.markdown("""
-    The tool can handle trees with hundreds of sequences. Very large trees (>1000 sequences)
-    may take longer to process and render. If you experience performance issues with very
-    large datasets, consider:
+    The tool can handle trees with tens of thousands of sequences. Every leaf is drawn by default;
+    setting "Draw at most this many leaves" in the Tree Settings draws the largest clades of
+    larger trees (after clones are stacked) as wedges, so drawing stays fast however large the
+    tree is. The downloaded figures are then simplified the same way. To make a large tree
+    easier to read, consider:
 
+    - Drawing at most a few thousand leaves, and drilling down into the clades you need
     - Simplifying your tree by removing distant outgroups
     - Increasing the clonality threshold to collapse more nodes
-    - Processing subsets of your data separately
     """)
 
 with st.expander("❓ Why isn't my custom outgroup working?"):
@@ -330,7 +376,7 @@ with st.expander("🔧 Technical Details (Advanced)"):
     ### Implementation Details
 
     **Clone Detection Algorithm:**
-    - Pairwise distance calculation using ETE3 toolkit
+    - Each leading node only searches clades close enough to hold a clone (no all-pairs distances)
     - Sequences within threshold distance are grouped
     - Weight assignment for visualization (number of collapsed sequences)
     - Preserves branch lengths during pruning
@@ -353,8 +399,8 @@ with st.expander("🔧 Technical Details (Advanced)"):
     ### Dependencies
     - Python 3.12
     - Streamlit (web interface)
-    - ETE3 (tree manipulation and rendering)
-    - PyQt5 (rendering backend)
+    - ETE3 (tree manipulation, optional rendering)
+    - PyQt5 (PDF/PNG export, ete3 rendering backend)
     - pandas, numpy (data processing)
     - lxml (SVG manipulation)
     """)
@@ -0,0 +1,392 @@
+"""
+render_engine.py
+    This python file contains the render engine of Koalafy:
+    it analyses a tree (rooting, clone calling, SeqType and
+    Classification annotation and stacking) and draws it, with
+    its inputs and outputs in memory. The Homepage runs it in
+    the render pool (render_pool.py), tree-render-function.py
+    is a thin command line wrapper around it, and other Python
+    code can import it and render trees in its own process.
+    The analysis is kept apart from the drawing, so a tree can
+    be drawn again with other colors, shapes or drawing
+    settings, or one of its clades drawn, without analysing it
+    again.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import os
+import tempfile
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from array_tree import prepare_tree
+from newick_reader import read_tree
+from clone_detection import find_clone_groups, tally_clone_groups, clone_workers, clone_merge_table
+from alignment_clones import read_fasta, find_alignment_clone_groups, alignment_merge_table
+from distance_index import DistanceIndex, clone_distance_table
+from leaf_annotation import match_seqtypes, match_classifications, match_seqtype_tags, match_class_tags
+from leaf_annotation import NHX_SEQTYPE, NHX_CLASS
+from stack_layout import plan_stacks, summarize_stacks, STACK_SUMMARY_SIZE
+from svg_render import render_svg, parser_styles
+from clade_detail import plan_wedges, wedge_stacks, clade_leaves, clade_depths, DETAIL_LEAVES, PREVIEW_LEAVES
+
+# formats render() can return the drawn tree in
+OUTPUT_FORMATS = ["svg", "pdf", "png"]
+
+
+class RenderSettings:
+    """
+    This class holds the settings of a render: how the tree is rooted,
+    how clones are called and annotated and how the tree is drawn. The
+    Homepage passes them as a one-row kwargs table (see from_kwargs()).
+    """
+
+    def __init__(self, ts_scale=10000, clone_threshold=1e-06, leaf_name_bool=False, rooting_node="midpoint",
+                 max_mismatches=0, parallel_clones=False, annotation_mode="parser",
+                 stack_summary_size=STACK_SUMMARY_SIZE, detail_leaves=DETAIL_LEAVES, detail_resolution=0.0,
+                 renderer="native", preview=False):
+        self.ts_scale = ts_scale  # pixels per unit of branch length
+        self.clone_threshold = clone_threshold
+        self.leaf_name_bool = leaf_name_bool
+        self.rooting_node = rooting_node  # outgroup name, midpoint rooting if not found
+        self.max_mismatches = max_mismatches  # clone threshold when an alignment is given
+        self.parallel_clones = parallel_clones  # search the clones of large trees on the CPUs available
+        self.annotation_mode = annotation_mode  # "parser" (leaf names) or "nhx" (NHX tags)
+        self.stack_summary_size = stack_summary_size
+        self.detail_leaves = detail_leaves  # 0 draws every leaf
+        self.detail_resolution = detail_resolution
+        self.renderer = renderer  # "native" (svg_render) or "ete3"
+        self.preview = preview
+
+    @classmethod
+    def from_kwargs(cls, kwargs):
+        """
+        This function reads the settings from the kwargs table of the
+        Homepage, as a DataFrame or CSV text. Settings that are not in it
+        keep their defaults.
+        """
+        if isinstance(kwargs, str):
+            kwargs = pd.read_csv(StringIO(kwargs))
+        settings = cls(ts_scale=kwargs["ts_scale"].iloc[0], clone_threshold=kwargs["clone_threshold"].iloc[0],
+                       leaf_name_bool=kwargs["leaf_name_bool"].iloc[0], rooting_node=kwargs["rooting_node"].iloc[0])
+        if "max_mismatches" in kwargs.columns:
+            settings.max_mismatches = kwargs["max_mismatches"].iloc[0]
+        settings.parallel_clones = "parallel_clones" in kwargs.columns and bool(kwargs["parallel_clones"].iloc[0])
+        if "annotation_mode" in kwargs.columns:
+            settings.annotation_mode = kwargs["annotation_mode"].iloc[0]
+        # stacks with more clones than this are summarized as "glyph x N"
+        if "stack_summary_size" in kwargs.columns:
+            settings.stack_summary_size = kwargs["stack_summary_size"].iloc[0]
+        # trees with more leaves than this (after stacking clones) have their
+        # largest clades drawn as wedges, as have clades shallower than the resolution
+        if "detail_leaves" in kwargs.columns:
+            settings.detail_leaves = int(kwargs["detail_leaves"].iloc[0])
+        if "detail_resolution" in kwargs.columns:
+            settings.detail_resolution = float(kwargs["detail_resolution"].iloc[0])
+        if "renderer" in kwargs.columns and kwargs["renderer"].iloc[0] == "ete3":
+            settings.renderer = "ete3"
+        settings.preview = "preview" in kwargs.columns and bool(kwargs["preview"].iloc[0])
+        return settings
+
+
+def render(tree, parser_df, settings, class_df=None, alignment=None, clones=None, outputs=("svg",), dpi=None,
+           progress=None):
+    """
+    This function analyses and draws a tree and returns the results as a
+    dictionary: the drawing in every format of outputs ("svg" text and
+    "pdf" and "png" bytes, PNGs drawn at dpi), the "style" map of native
+    SVGs, the "clones" table (the leading leaf of every leaf) and the
+    "analysis" to draw the tree or its clades again. The inputs are as
+    for analyse_tree(), and a "preview" SVG is added if settings ask
+    for it. PDFs and PNGs start Qt, which has to run in the main thread.
+    progress, if given, is called with the name of every stage, and
+    with the preview once it is drawn.
+    """
+    for output in outputs:
+        if output not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported export format: {output}")
+    analysis = analyse_tree(tree, parser_df, settings, class_df, alignment, clones, progress)
+    result = {"analysis": analysis, "clones": analysis["clones"]}
+    if settings.preview:
+        result["preview"], _ = draw_analysis(analysis, parser_df, settings, preview=True, progress=progress)
+    # the preview is passed on with the stage of drawing the tree
+    svg, style = draw_analysis(analysis, parser_df, settings, progress=progress,
+                               results={"preview": result["preview"]} if settings.preview else None)
+    result["style"] = style
+    for output in outputs:
+        if output == "svg":
+            result["svg"] = svg
+        else:
+            from tree_export import export_bytes, EXPORT_DPI  # starts Qt
+            report(progress, f"Making the {output.upper()}")
+            result[output] = export_bytes(svg, output, dpi or EXPORT_DPI)
+    return result
+
+
+def analyse_tree(tree, parser_df, settings, class_df=None, alignment=None, clones=None, progress=None):
+    """
+    This function reads and analyses a tree for drawing. tree is a Newick
+    file path, bytes or binary file object (possibly compressed),
+    parser_df the parser table and class_df the Classification table or
+    None. Clones are taken from clones (a table of the leading leaf of
+    every leaf, as made by the Homepage) if it matches the tree, else
+    called from the FASTA alignment (a path, bytes or file object) if
+    given, else from branch lengths. It returns the analysis as a
+    dictionary (see draw_analysis()), with the clones called as such a
+    table. progress, if given, is called with the name of every stage.
+    """
+    # Reading in newick tree file, possibly compressed, the analysis runs
+    # on the arrays of an ArrayTree
+    report(progress, "Reading the tree")
+    t = read_tree(tree)
+
+    if class_df is not None:
+        classification_default = class_df.loc[1, "Classification"] # circle
+        classification_alternate = class_df.loc[0, "Classification"] # square
+        class_parser = class_df.loc[0, "Parser"] # parser for squares
+    else:
+        classification_default = "default"
+        classification_alternate = "alternate"
+
+    # Midpoint (or outgroup) rooting and ladderizing tree
+    report(progress, "Rooting the tree")
+    t = prepare_tree(t, settings.rooting_node)
+
+    # group leaves into clones, this only depends on the tree, rooting and threshold
+    # (not on SeqType), so the Homepage can hand over groups it already has
+    report(progress, "Calling clones")
+    leaf_names = t.leaf_names()
+    leader_of = None
+    if clones is not None and clones["leaf"].astype(str).to_list() == leaf_names:
+        leader_of = clones["leader"].to_list()
+    if leader_of is None and alignment is not None:
+        leader_of = find_alignment_clone_groups(t, read_fasta(alignment), settings.max_mismatches)
+    if leader_of is None:
+        leader_of = find_clone_groups(t, settings.clone_threshold,
+                                      clone_workers(t) if settings.parallel_clones else None)
+
+    # Dataframe to track different SeqTypes that are clones
+    report(progress, "Stacking clones")
+    df_cols = parser_df['SeqType'].to_list()
+
+    # annotating Sequence Type and Classification codes from the leaf names,
+    # or from the SeqType and Class NHX tags read with the tree
+    if settings.annotation_mode == "nhx":
+        seqtype_rows = match_seqtype_tags(t.leaf_feature(NHX_SEQTYPE), parser_df)
+    else:
+        seqtype_rows = match_seqtypes(leaf_names, parser_df)
+    unmapped = bool((seqtype_rows == -1).any()) # toggle for unmapped seqs
+    # if unmapped seqs exist, then add that to df_cols
+    if unmapped:
+        df_cols.append(False)
+    t.seqtype[t.leaves] = np.where(seqtype_rows == -1, len(df_cols) - 1, seqtype_rows)
+    if class_df is not None and settings.annotation_mode == "nhx":
+        t.classification[t.leaves] = match_class_tags(t.leaf_feature(NHX_CLASS), classification_alternate)
+    elif class_df is not None:
+        t.classification[t.leaves] = match_classifications(leaf_names, class_parser)
+    else:
+        t.classification[t.leaves] = 0
+    classification_values = [classification_default, classification_alternate]
+
+    # tally clones onto their leading leaf by SeqType and Classification
+    weight, clone_counts = tally_clone_groups(leaf_names, leader_of, t.seqtype[t.leaves],
+                                              t.classification[t.leaves], df_cols)
+
+    # drop leaves with weight = -1 while preserving branch lengths, only
+    # the reduced tree is drawn
+    reduced, origin = t.collapse(t.leaves[weight != -1])
+    kept = np.searchsorted(t.leaves, origin[reduced.leaves]) # leaf positions before collapsing
+    leaf_classifications = [classification_values[c] for c in reduced.classification[reduced.leaves]]
+    leaf_seqtypes = [df_cols[c] for c in reduced.seqtype[reduced.leaves]] # False if no parser was matched
+    leaf_weights = [int(w) for w in weight[kept]]
+    # glyphs of every stacked node, planned once instead of on every render
+    stacks = plan_stacks(reduced.leaf_names(), leaf_seqtypes,
+                         [c == classification_alternate for c in leaf_classifications], leaf_weights, clone_counts)
+
+    leaf_square = [c != classification_default for c in leaf_classifications]
+    class_legend = (classification_alternate, classification_default) if class_df is not None else None
+    return {"tree": reduced, "seqtypes": leaf_seqtypes, "square": leaf_square, "stacks": stacks,
+            "unmapped": unmapped, "class_legend": class_legend,
+            "clones": pd.DataFrame({"leaf": leaf_names, "leader": leader_of}),
+            "clone_leaders": {leaf_names[i]: leaf_names[leader] for i, leader in enumerate(leader_of)
+                              if leader != i}}
+
+
+def search_clones(tree, rooting_node, thresholds, parallel=False):
+    """
+    This function roots a tree and searches it for clones at every
+    threshold in one go (see clone_detection.clone_merge_table()). With
+    parallel, large trees are searched on the CPUs available.
+    """
+    t = prepare_tree(read_tree(tree), rooting_node)
+    return clone_merge_table(t, thresholds, clone_workers(t) if parallel else None)
+
+
+def search_clone_distances(tree, rooting_node, names, leader_of):
+    """
+    This function roots a tree and returns the within-clone and nearest
+    neighbour distances of every stacked node, for the names and leading
+    leaves of the leaves in iter_leaves() order (see
+    distance_index.clone_distance_table()). The distance index is built
+    here, so only the small table is sent back.
+    """
+    t = prepare_tree(read_tree(tree), rooting_node)
+    return clone_distance_table(DistanceIndex.from_tree(t), names, leader_of)
+
+
+def search_alignment_clones(tree, rooting_node, alignment, thresholds):
+    """
+    This function roots a tree and searches its FASTA alignment for
+    clones at every mismatch threshold in one go (see
+    alignment_clones.alignment_merge_table()).
+    """
+    t = prepare_tree(read_tree(tree), rooting_node)
+    return alignment_merge_table(t, read_fasta(alignment), thresholds)
+
+
+def search_clone_groups(tree, rooting_node, threshold):
+    """
+    This function roots a tree and returns the leading leaf position of
+    every leaf at one threshold.
+    """
+    return find_clone_groups(prepare_tree(read_tree(tree), rooting_node), threshold)
+
+
+def clade_analysis(analysis, query):
+    """
+    This function returns the analysis of the clade picked by query (see
+    find_clade()), so it can be drawn on its own.
+    """
+    t = analysis["tree"]
+    clade, origin = t.subtree(find_clade(analysis, query))
+    kept = np.searchsorted(t.leaves, origin[clade.leaves])  # leaf positions in the whole tree
+    return dict(analysis, tree=clade, seqtypes=[analysis["seqtypes"][i] for i in kept],
+                square=[analysis["square"][i] for i in kept], stacks=[analysis["stacks"][i] for i in kept])
+
+
+def render_clade(analysis, query, parser_df, settings):
+    """
+    This function draws the clade picked by query (see find_clade()) of
+    an analysis, without analysing the tree again, and returns its SVG
+    text.
+    """
+    svg, style = draw_analysis(clade_analysis(analysis, query), parser_df, settings)
+    return svg
+
+
+def find_clade(analysis, query):
+    """
+    This function returns the node of the analysed tree picked by query:
+    the common ancestor of the leaves named in it, separated by commas.
+    A name that is not a sequence (clones stand for their leading leaf)
+    picks every sequence with it in its name, such as a participant or a
+    timepoint. A single leaf picks the clade of its parent.
+    """
+    t = analysis["tree"]
+    leaders = analysis["clone_leaders"]
+    nodes = set()
+    for name in [name.strip() for name in query.split(",") if name.strip()]:
+        matches = t.search(leaders.get(name, name)).tolist()
+        if not matches:
+            found = {t.names[t.name_id[leaf]] for leaf in t.leaves.tolist() if name in t.names[t.name_id[leaf]]}
+            found.update(leader for clone, leader in leaders.items() if name in clone)
+            matches = [node for leader in found for node in t.search(leader).tolist()]
+        if not matches:
+            raise ValueError(f"No sequence called {name}")
+        nodes.update(matches)
+    if not nodes:
+        raise ValueError("No clade given")
+    node = t.common_ancestor(list(nodes))
+    if len(nodes) == 1 and node != 0:
+        node = int(t.parent[node])
+    return node
+
+
+def draw_analysis(analysis, parser_df, settings, preview=False, progress=None, results=None):
+    """
+    This function draws the analysed tree with the colors and shapes of
+    the parser table and the drawing settings, and returns the SVG text
+    and its style map (for svg_render.restyle_svg(), None for trees
+    drawn by ete3). A preview is drawn natively with at most
+    PREVIEW_LEAVES leaves and without leaf names or legend. progress, if
+    given, is told when drawing starts, with the results to pass on.
+    """
+    report(progress, "Drawing a preview" if preview else "Drawing the tree", **(results or {}))
+    reduced = analysis["tree"]
+    leaf_seqtypes = analysis["seqtypes"]
+    stacks = analysis["stacks"]
+    unmapped = analysis["unmapped"]
+    class_legend = analysis["class_legend"]
+
+    leaf_name_bool = settings.leaf_name_bool
+    detail_leaves = settings.detail_leaves
+    renderer = settings.renderer
+    if preview:
+        leaf_name_bool = False
+        detail_leaves = min(detail_leaves, PREVIEW_LEAVES) if detail_leaves else PREVIEW_LEAVES
+        renderer = "native"
+
+    # Colormap for seq type (black for the unmapped False seqtype) and
+    # any shapes to update
+    seqtype_cmap, shape_update_dict = parser_styles(parser_df, unmapped)
+
+    # what is drawn for every leaf of the reduced tree, SeqTypes are given
+    # by their position in the legend, large stacks are summarized as "glyph x N"
+    legend = list(seqtype_cmap.items())
+    legend_keys = {seqtype: k for k, seqtype in enumerate(seqtype_cmap)}
+    leaf_types = [legend_keys[seqtype] for seqtype in leaf_seqtypes]
+    leaf_square = analysis["square"]
+    leaf_stacks = summarize_stacks(stacks, legend_keys, settings.stack_summary_size)
+
+    # level of detail: clades that are not opened within the budget are cut
+    # off and drawn as wedges, stacked with the sequences of every SeqType
+    drawn = reduced
+    leaf_wedges = None
+    wedges = plan_wedges(reduced, detail_leaves, settings.detail_resolution)
+    if len(wedges):
+        leaf_counts = np.zeros((len(reduced.leaves), len(legend)), dtype=np.int64)
+        for i, (seqtype, glyphs) in enumerate(zip(leaf_seqtypes, stacks)):
+            leaf_counts[i, legend_keys[seqtype]] += 1
+            for shape, clone_seqtype, column in glyphs:
+                leaf_counts[i, legend_keys[clone_seqtype]] += 1
+        wedge_glyphs = wedge_stacks(reduced, wedges, leaf_counts)
+        leaves_below = clade_leaves(reduced)
+        depth = clade_depths(reduced)
+        drawn, origin = reduced.cut(wedges)
+        drawn_from = origin[drawn.leaves]
+        is_wedge = np.isin(drawn_from, wedges).tolist()
+        # position of every drawn leaf in wedges, or in the leaves of reduced
+        position = np.where(is_wedge, np.searchsorted(wedges, drawn_from),
+                            np.searchsorted(reduced.leaves, drawn_from)).tolist()
+        leaf_wedges = [(depth[node], leaves_below[node]) if wedge else None
+                       for node, wedge in zip(drawn_from.tolist(), is_wedge)]
+        leaf_types = [-1 if wedge else leaf_types[p] for p, wedge in zip(position, is_wedge)]
+        leaf_square = [False if wedge else leaf_square[p] for p, wedge in zip(position, is_wedge)]
+        leaf_stacks = [wedge_glyphs[p] if wedge else leaf_stacks[p] for p, wedge in zip(position, is_wedge)]
+
+    # the tree is only drawn once, as an SVG, PDF and PNG files are made
+    # from it by tree_export.py when they are downloaded
+    if renderer == "ete3":
+        from ete3_render import render_ete3 # starts Qt
+        # ete3 only draws into files
+        with tempfile.TemporaryDirectory() as directory:
+            svg_file = os.path.join(directory, "tree-file.svg")
+            render_ete3(drawn, leaf_types, leaf_square, leaf_stacks, legend, class_legend,
+                        shape_update_dict, settings.ts_scale, leaf_name_bool, svg_file, leaf_wedges)
+            with open(svg_file, encoding="utf-8", newline="") as file:
+                return file.read(), None
+    svg, style_map = render_svg(drawn, leaf_types, leaf_square, leaf_stacks, legend, class_legend,
+                                shape_update_dict, settings.ts_scale, leaf_name_bool, leaf_wedges, not preview)
+    # the Homepage restyles the SVG with this when only colors or shapes are edited
+    return svg, {"unmapped": unmapped, "glyphs": style_map}
+
+
+def report(progress, stage, **results):
+    """
+    This function tells progress, if given, the stage the render is at,
+    with the results it passes on before the render is done.
+    """
+    if progress is not None:
+        progress(stage, **results)
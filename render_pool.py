@@ -0,0 +1,438 @@
+"""
+render_pool.py
+    This python file contains the pool of render workers of
+    the Homepage. Every worker is a process that imports the
+    render engine (pandas, numpy, lxml, ete3 and PyQt5) and
+    starts Qt offscreen once, then calls the functions of the
+    render engine (such as render_engine.render() and
+    tree_export.export_bytes()) in its main thread for every
+    job it is sent over a pipe, so jobs do not pay for
+    starting Python, importing and starting Qt. Their
+    arguments and results are sent over the pipe as well, so
+    the jobs of different sessions share no files.
+    Workers are replaced by fresh ones after WORKER_MAX_JOBS
+    jobs, once they have used WORKER_MAX_MEMORY or if they
+    stop. Fresh workers that fail to start are tried again,
+    and jobs in line are stopped while no worker is running.
+    Jobs wait in line for a free worker, so no more trees are
+    drawn at once than there are workers, and no more than
+    MAX_QUEUED_JOBS jobs are let in line. Running jobs send
+    back the stages they report and are stopped (their worker
+    killed and replaced) by the thread looking after their
+    worker when they are cancelled or go over JOB_TIMEOUT or
+    JOB_MAX_MEMORY, even if nobody waits for them any more.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import atexit
+import collections
+import inspect
+import multiprocessing
+import os
+import pickle
+import resource
+import signal
+import threading
+import time
+import traceback
+
+RENDER_WORKERS = 2
+WORKER_MAX_JOBS = 50
+WORKER_MAX_MEMORY = 2 * 1024 ** 3  # peak memory of a worker, in bytes
+
+# jobs let in line at most, and the limits of a running job
+MAX_QUEUED_JOBS = 20
+JOB_TIMEOUT = 600  # seconds
+JOB_MAX_MEMORY = 4 * 1024 ** 3  # bytes
+# longest wait between attempts to start a worker that failed to start
+MAX_RESTART_DELAY = 60  # seconds
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class RenderQueueFull(RuntimeError):
+    """
+    This class is the error of jobs that are not let in line, as
+    MAX_QUEUED_JOBS jobs are already waiting.
+    """
+
+
+class RenderJobStopped(RuntimeError):
+    """
+    This class is the error of jobs that were cancelled or stopped for
+    their limits, or whose worker stopped.
+    """
+
+
+class RenderPool:
+    """
+    This class holds the render workers and the jobs waiting for them.
+    Jobs are a function that can be imported by the workers (one of the
+    render engine) and its arguments, and are given workers in the
+    order they were started. Every worker is
+    looked after by a thread of the pool, which stops its jobs when they
+    are cancelled or go over their limits, whether or not anyone is
+    still waiting for them.
+    """
+
+    def __init__(self, workers=RENDER_WORKERS, max_jobs=WORKER_MAX_JOBS, max_memory=WORKER_MAX_MEMORY,
+                 max_queued=MAX_QUEUED_JOBS, timeout=JOB_TIMEOUT, job_max_memory=JOB_MAX_MEMORY):
+        # workers are started fresh, as forking the threads of the server is unsafe
+        self.context = multiprocessing.get_context("spawn")
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.job_max_memory = job_max_memory
+        self.lock = threading.Condition()
+        self.waiting = collections.deque()
+        self.size = workers
+        self.workers = []  # every worker started, to stop them on exit
+        self.closed = False
+        self.stopped = threading.Event()  # set when the pool is closed
+        for _ in range(workers):
+            threading.Thread(target=self.look_after, args=(self.start_worker(),), daemon=True).start()
+        # workers are not daemons, so they can start the processes of the
+        # parallel clone search, and are stopped here when the server exits
+        atexit.register(self.close)
+
+    def start_worker(self):
+        """
+        This function starts a worker and returns it. It warms up before
+        it reads its first job.
+        """
+        connection, worker_connection = self.context.Pipe()
+        process = self.context.Process(target=serve, args=(worker_connection, self.size))
+        process.start()
+        worker_connection.close()
+        worker = {"process": process, "connection": connection, "jobs": 0}
+        with self.lock:
+            self.workers = [w for w in self.workers if w["process"].is_alive()] + [worker]
+        return worker
+
+    def start(self, function, *args, **kwargs):
+        """
+        This function puts a job calling function with args and kwargs in
+        line and returns it as a RenderJob, without waiting for it. It
+        raises RenderQueueFull if the line is full.
+        """
+        job = RenderJob(self, function, args, kwargs)
+        with self.lock:
+            if len(self.waiting) >= self.max_queued:
+                raise RenderQueueFull(f"{len(self.waiting)} trees are already waiting to be drawn")
+            self.waiting.append(job)
+            self.lock.notify()
+        return job
+
+    def run(self, function, *args, **kwargs):
+        """
+        This function runs a job and returns its result, or raises its
+        error.
+        """
+        return self.start(function, *args, **kwargs).result()
+
+    def position(self, job):
+        """
+        This function returns the number of jobs in line before job, or
+        None if it is not in line.
+        """
+        with self.lock:
+            return self.waiting.index(job) if job in self.waiting else None
+
+    def look_after(self, worker):
+        """
+        This function is the thread of a worker. It gives the worker the
+        jobs first in line, one at a time, and puts a fresh worker in its
+        place when it has done enough jobs, used too much memory or was
+        stopped.
+        """
+        while True:
+            with self.lock:
+                while not self.waiting and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    break
+                job = self.waiting.popleft()
+                job.started = time.monotonic()
+            memory = self.run_job(worker, job)
+            worker["jobs"] += 1
+            if self.closed:
+                break
+            if memory is None or worker["jobs"] >= self.max_jobs or memory >= self.max_memory:
+                stop_worker(worker)
+                worker = self.replace_worker()
+                if worker is None:
+                    return
+        stop_worker(worker)
+
+    def replace_worker(self):
+        """
+        This function starts a fresh worker in place of a stopped one and
+        returns it, or None once the pool is closed. A worker that fails
+        to start is tried again after a growing delay, and while no worker
+        of the pool is running the jobs in line are stopped, so nobody
+        waits for them forever.
+        """
+        delay = 1
+        while not self.closed:
+            try:
+                return self.start_worker()
+            except Exception:
+                traceback.print_exc()  # such as a limit on the number of processes
+            with self.lock:
+                if not any(w["process"].is_alive() for w in self.workers):
+                    while self.waiting:
+                        self.waiting.popleft().finish(error=RenderJobStopped("no render worker could be started"))
+            self.stopped.wait(delay)
+            delay = min(2 * delay, MAX_RESTART_DELAY)
+        return None
+
+    def run_job(self, worker, job):
+        """
+        This function runs a job in a worker and returns the peak memory
+        of the worker, or None if it was stopped. The stages the job
+        reports, and the results it passes on with them, are kept while
+        it runs.
+        """
+        connection = worker["connection"]
+        try:
+            connection.send((job.function, job.args, job.kwargs))
+        except (BrokenPipeError, EOFError, OSError):
+            job.finish(error=RenderJobStopped("the render worker stopped"))
+            return None
+        except Exception as e:  # the job could not be pickled, nothing was sent
+            job.finish(error=e)
+            return 0
+        while True:
+            try:
+                if connection.poll(0.1):
+                    message = connection.recv()
+                    if message[0] == "progress":
+                        job.stage = message[1]
+                        job.results.update(message[2])
+                        continue
+                    _, value, error, memory = message
+                    job.finish(value, error)
+                    return memory
+            except (EOFError, OSError):
+                job.finish(error=RenderJobStopped("the render worker stopped"))
+                return None
+            except Exception as e:  # the result could not be unpickled
+                job.finish(error=e)
+                return None
+            if job.cancelled:
+                message = "it was cancelled"
+            elif not worker["process"].is_alive():
+                message = "the render worker stopped"
+            elif time.monotonic() - job.started > self.timeout:
+                message = f"it took longer than {self.timeout} seconds"
+            elif worker_memory(worker) > self.job_max_memory:
+                message = f"it needed more than {self.job_max_memory // 1024 ** 2} MB of memory"
+            else:
+                continue
+            kill_worker(worker)
+            job.finish(error=RenderJobStopped(message))
+            return None
+
+    def close(self):
+        """
+        This function stops the workers, idle or running a job, and their
+        threads.
+        """
+        with self.lock:
+            self.closed = True
+            self.stopped.set()
+            self.lock.notify_all()
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            kill_worker(worker)
+
+
+class RenderJob:
+    """
+    This class is a job of the pool. It is polled until it is done, and
+    then has the value the function returned or the error it raised.
+    stage is the last stage the function reported, and results the
+    results it passed on with them, such as the preview of a tree.
+    """
+
+    def __init__(self, pool, function, args, kwargs):
+        self.pool = pool
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.started = None  # when it was given a worker
+        self.stage = None
+        self.results = {}
+        self.cancelled = False
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+
+    def poll(self, timeout=0):
+        """
+        This function returns whether the job is done, waiting at most
+        timeout seconds for it.
+        """
+        return self.done.wait(timeout)
+
+    def result(self):
+        """
+        This function waits for the job to finish and returns its value,
+        or raises its error.
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def position(self):
+        """
+        This function returns the number of jobs in line before this one,
+        or None once it has a worker.
+        """
+        return self.pool.position(self)
+
+    def cancel(self):
+        """
+        This function stops the job, waiting or running, unless it is
+        done. Running jobs are stopped by the thread of their worker.
+        """
+        with self.pool.lock:
+            if self in self.pool.waiting:
+                self.pool.waiting.remove(self)
+                self.finish(error=RenderJobStopped("it was cancelled"))
+            elif not self.done.is_set():
+                self.cancelled = True
+
+    def finish(self, value=None, error=None):
+        """
+        This function ends the job.
+        """
+        self.value, self.error = value, error
+        self.done.set()
+
+
+def worker_memory(worker):
+    """
+    This function returns the memory a worker and the processes it
+    started use now, in bytes (0 where it cannot be read).
+    """
+    memory = 0
+    for pid in process_tree(worker["process"].pid):
+        try:
+            with open(f"/proc/{pid}/statm") as file:
+                memory += int(file.read().split()[1]) * _PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            pass
+    return memory
+
+
+def process_tree(pid):
+    """
+    This function returns the process pid and the processes it started,
+    and so on, as far as /proc lists them.
+    """
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open(f"/proc/{parent}/task/{parent}/children") as file:
+                pids.extend(int(child) for child in file.read().split())
+        except (OSError, ValueError):
+            pass
+    return pids
+
+
+def kill_worker(worker):
+    """
+    This function kills a worker at once, with the processes it started.
+    """
+    for pid in reversed(process_tree(worker["process"].pid)[1:]):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    worker["process"].kill()
+    worker["process"].join()
+    worker["connection"].close()
+
+
+def stop_worker(worker):
+    """
+    This function stops an idle worker.
+    """
+    try:
+        worker["connection"].send(None)
+    except (BrokenPipeError, EOFError, OSError):
+        pass
+    worker["connection"].close()
+    worker["process"].join(timeout=5)
+    if worker["process"].is_alive():
+        kill_worker(worker)
+
+
+def serve(connection, share=1):
+    """
+    This function is the main loop of a worker: it warms up, then runs
+    the jobs it reads from connection until it is sent None. The stages
+    a job reports are sent back as ("progress", stage, results) while it
+    runs, and the job is answered with ("done", value, error, peak
+    memory in bytes). The CPUs are shared with the other share - 1
+    workers of the pool, which may search for clones at the same time.
+    """
+    import clone_detection
+
+    clone_detection.CPU_SHARE = share
+    clone_detection.start_fork_server()  # before Qt starts threads
+    warm_up()
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        value, error = run_function(*job, connection)
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        try:
+            connection.send(("done", value, error, memory))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            connection.send(("done", None, RuntimeError(f"The result could not be sent back ({e})"), memory))
+
+
+def warm_up():
+    """
+    This function imports the render engine and draws a tiny tree with
+    ete3, which starts Qt offscreen the way ete3 does, so jobs find
+    everything loaded.
+    """
+    os.environ["QT_QPA_PLATFORM"] = "offscreen"
+    import pandas as pd
+    from render_engine import RenderSettings, analyse_tree, draw_analysis
+    import PyQt5.QtSvg  # noqa: F401 (PDF and PNG export, see tree_export.py)
+
+    parser_df = pd.DataFrame({"SeqType": ["A"], "Parser": ["A"], "Color": ["#000000"], "Shape": ["Circle"]})
+    settings = RenderSettings(renderer="ete3")
+    draw_analysis(analyse_tree(b"(A_1:1,A_2:1);", parser_df, settings), parser_df, settings)
+
+
+def run_function(function, args, kwargs, connection):
+    """
+    This function calls function with args and kwargs, and returns its
+    value and None, or None and the error it raised (its traceback is
+    logged). Functions with a progress parameter are given one that
+    sends their stages back over connection.
+    """
+    if "progress" in inspect.signature(function).parameters:
+        def progress(stage, **results):
+            connection.send(("progress", stage, results))
+        kwargs = dict(kwargs, progress=progress)
+    try:
+        return function(*args, **kwargs), None
+    except Exception as e:
+        traceback.print_exc()  # errors are logged by the server as before
+        try:
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            e = RuntimeError(f"{type(e).__name__}: {e}")
+        return None, e
@@ -0,0 +1,88 @@
+"""
+stack_layout.py
+    This python file contains the layout plan of the stacked
+    nodes: the glyphs (shape, SeqType and face column) drawn
+    to the right of every leading leaf for its clones.
+    The plan is worked out once from the clone counts, so the
+    ete3 layout function only attaches faces that are already
+    made and nothing is tallied while the tree is drawn.
+    Stacks above STACK_SUMMARY_SIZE glyphs are summarized as
+    one glyph and a count for every kind of glyph.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import numpy as np
+
+CIRCLE = "circle"
+SQUARE = "square"
+STACK_GLYPH_SIZE = 8  # width and height of a glyph, in pixels
+
+# stacks with more glyphs are drawn as one glyph and a count per kind
+STACK_SUMMARY_SIZE = 50
+
+
+def plan_stacks(names, seqtypes, alternate, weights, clone_counts):
+    """
+    This function returns, for every leading leaf, the list of glyphs of
+    its stack as (shape, SeqType, column) tuples in the order they are
+    drawn. The leaves are given by name, SeqType, whether they have the
+    alternate Classification and their Weight, and the clones of other
+    SeqTypes and Classifications are read from clone_counts.
+    Leaves of the default Classification stack circles in odd columns,
+    leaves of the alternate one start with squares in even columns, and
+    squares of mixed stacks are put in between at column + 0.02.
+    """
+    types = clone_counts.types
+    stacks = []
+    for name, seqtype, is_alternate, weight in zip(names, seqtypes, alternate, weights):
+        own_shape, other_shape = (SQUARE, CIRCLE) if is_alternate else (CIRCLE, SQUARE)
+        other_counts = clone_counts.other_counts(name)
+        alternate_counts = clone_counts.alternate_counts(name)
+
+        # clones of the same SeqType but the other Classification are drawn
+        # with the mixed clones
+        alt_value = int(alternate_counts[clone_counts.code[seqtype]])
+        weight_range = int(weight) - alt_value if alt_value > 0 else int(weight)
+        own_offset = 0 if is_alternate else 1
+        glyphs = [(own_shape, seqtype, i * 2 + own_offset) for i in range(weight_range)]
+
+        # then the clones of every SeqType, same Classification first
+        spot_sum = weight_range
+        for code_i in np.flatnonzero(other_counts | alternate_counts):
+            alt_value = int(alternate_counts[code_i])
+            for shape, count in ((own_shape, int(other_counts[code_i]) - alt_value), (other_shape, alt_value)):
+                for _ in range(count):
+                    column = spot_sum * 2 + (1 if shape == CIRCLE else 1.02)
+                    glyphs.append((shape, types[code_i], column))
+                    spot_sum += 1
+        stacks.append(glyphs)
+    return stacks
+
+
+def summarize_stack(glyphs):
+    """
+    This function returns the summary of a stack: one (shape, SeqType,
+    count) tuple for every kind of glyph in it, in the order they first
+    appear.
+    """
+    counts = {}
+    for shape, seqtype, column in glyphs:
+        counts[(shape, seqtype)] = counts.get((shape, seqtype), 0) + 1
+    return [(shape, seqtype, count) for (shape, seqtype), count in counts.items()]
+
+
+def summarize_stacks(stacks, seqtype_keys, summary_size=STACK_SUMMARY_SIZE):
+    """
+    This function returns every stack of plan_stacks() as a tuple of
+    (shape, key, count) glyphs, the form both renderers draw, where key is
+    the one of the SeqType in seqtype_keys (its position in the legend).
+    Stacks of more than summary_size glyphs are summarized.
+    """
+    keyed = []
+    for glyphs in stacks:
+        if len(glyphs) > summary_size:
+            glyphs = summarize_stack(glyphs)
+        else:
+            glyphs = [(shape, seqtype, 1) for shape, seqtype, column in glyphs]
+        keyed.append(tuple((shape, seqtype_keys[seqtype], count) for shape, seqtype, count in glyphs))
+    return keyed
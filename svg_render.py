@@ -0,0 +1,431 @@
+"""
+svg_render.py
+    This python file contains the native SVG writer of the
+    tree. It draws Koalafy's fixed tree style (rectangular,
+    ladderized, stacked glyphs, legend, scale bar and optional
+    leaf names) straight from the ArrayTree, without ete3 or
+    Qt, and writes the final node shapes (triangle, diamond,
+    pentagon, square) directly.
+    Sizes and positions follow ete3's rectangular layout with
+    the TreeStyle set in tree-render-function.py, so trees look
+    the same as when drawn by ete3. Text is measured with Arial
+    (Helvetica) character widths, the font the SVG asks for.
+    Every colored glyph is written on a line of its own and
+    listed in a style map, so the colors and shapes of the
+    parser table can be changed on the SVG without drawing the
+    tree again (see restyle_svg()).
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import math
+from xml.sax.saxutils import escape
+
+from stack_layout import CIRCLE, SQUARE, STACK_GLYPH_SIZE
+from clade_detail import wedge_size, WEDGE_COLOR
+
+# TreeStyle settings of tree-render-function.py
+MARGIN_LEFT = 20
+MARGIN_RIGHT = 20
+MARGIN_TOP = 20
+MARGIN_BOTTOM = 1
+BRANCH_VERTICAL_MARGIN = 2
+LINE_WIDTH = 2
+SCALE_LENGTH = 50  # scale bar length, in pixels
+FONT = "Arial"
+
+# Helvetica (Arial) advance widths of the characters ' ' to '~', per 1000 em
+_CHAR_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+_DEFAULT_CHAR_WIDTH = 584  # other characters, such as the × of stack counts
+
+
+def text_size(text, size):
+    """
+    This function returns the width, height and baseline (from the top)
+    in pixels of text written in Arial at size points.
+    """
+    pixels = size * 96 / 72
+    width = sum(_CHAR_WIDTHS[ord(c) - 32] if 32 <= ord(c) < 127 else _DEFAULT_CHAR_WIDTH for c in text)
+    return width * pixels / 1000, round(pixels * 1.15), round(pixels * 0.905)
+
+
+def shape_points(shape, cx, cy, r):
+    """
+    This function returns the points of a triangle, diamond, pentagon or
+    square drawn in place of a circle of radius r centered at cx, cy.
+    """
+    shape = shape.lower()
+    if shape == "triangle":
+        # equilateral triangle pointing upwards
+        points = [(cx + r * math.cos(math.radians(a)), cy + r * math.sin(math.radians(a))) for a in [-90, 30, 150]]
+    elif shape == "diamond":
+        points = [(cx, cy - r), (cx + r, cy), (cx, cy + r), (cx - r, cy)]
+    elif shape == "pentagon":
+        points = [(cx + r * math.cos(math.radians(-90 + i * 72)), cy + r * math.sin(math.radians(-90 + i * 72)))
+                  for i in range(5)]
+    elif shape == "square":
+        half = r * 0.75
+        points = [(cx - half, cy - half), (cx + half, cy - half), (cx + half, cy + half), (cx - half, cy + half)]
+    else:
+        # raise error if unsupported shape is passed
+        raise ValueError(f"Unsupported shape: {shape}")
+    return points
+
+
+def parser_styles(parser_df, unmapped):
+    """
+    This function returns the colormap of the SeqTypes of the parser
+    table, with black for the unmapped sequences (the False SeqType) if
+    there are any, and the shapes its colors are drawn as.
+    """
+    seqtype_cmap = dict(zip(parser_df['SeqType'], parser_df['Color']))
+    if unmapped:
+        seqtype_cmap[False] = 'black'
+    return seqtype_cmap, dict(zip(parser_df['Color'], parser_df['Shape']))
+
+
+def render_svg(t, leaf_types, leaf_square, stacks, legend, class_legend, shapes, scale, show_leaf_names,
+               wedges=None, show_legend=True):
+    """
+    This function draws the tree t (an ArrayTree, already collapsed and
+    ladderized) and returns it as SVG text with its style map. legend
+    lists the (label, color) of every SeqType (a False label is the
+    unmapped one). For every leaf, in t.leaves order, it is given its
+    SeqType as a position in legend, whether it is drawn as a square (the
+    alternate Classification) and its stack as (shape, SeqType position,
+    count) glyphs. class_legend is the (alternate, default)
+    Classification labels or None, and shapes maps parser colors to the
+    shape drawn instead of their circles. wedges gives the (depth, number
+    of leaves) of the leaves that stand for a whole clade, drawn as a
+    wedge instead of a ball, and None for the others. Without show_legend,
+    the legend is left out.
+    The style map lists every colored glyph as [line, SeqType position
+    (-1 for black), shape, cx, cy, size, outline] for restyle_svg().
+    """
+    n = len(t)
+    child_ptr = t.child_ptr.tolist()
+    child_idx = t.child_idx.tolist()
+    dist = t.dist.tolist()
+    names = t.names
+    name_id = t.name_id.tolist()
+
+    # node styles: leaves get a colored ball, the root a small black square
+    # and inner nodes only their branches
+    size = [0] * n
+    seqtype = [-1] * n  # position in legend, -1 is black
+    square = [False] * n
+    stack = [()] * n
+    wedge_w = [0.0] * n  # the wedge is drawn where the ball would be
+    wedge_h = [0.0] * n
+    for k, leaf in enumerate(t.leaves.tolist()):
+        if wedges is not None and wedges[k] is not None:
+            wedge_w[leaf], wedge_h[leaf] = wedge_size(*wedges[k], scale)
+        else:
+            square[leaf] = bool(leaf_square[k])
+            size[leaf] = 6 if square[leaf] else 8
+        seqtype[leaf] = leaf_types[k]
+        stack[leaf] = stacks[k]
+    size[0], square[0] = 3, True
+
+    # sizes of every node, children before their parent (ete3's init_items)
+    branch = [0.0] * n  # branch length in pixels
+    node_w = [0.0] * n  # width of the node's own branch, ball and faces
+    node_h = [0.0] * n
+    full_w = [0.0] * n  # width and height of the node and its clade
+    full_h = [0.0] * n
+    faces_w = [0.0] * n
+    faces_h = [0.0] * n
+    vt_width = [0.0] * n
+    face_columns = [None] * n
+    for node in range(n - 1, -1, -1):
+        children = child_idx[child_ptr[node]:child_ptr[node + 1]]
+        columns = []
+        if not children and show_leaf_names and names[name_id[node]]:
+            columns.append(("name", names[name_id[node]]) + text_size(names[name_id[node]], 10)[:2])
+        if stack[node]:
+            columns.append(("stack", stack[node]) + _stack_size(stack[node]))
+        face_columns[node] = columns
+        faces_w[node] = sum(column[2] for column in columns)
+        faces_h[node] = max([column[3] for column in columns], default=0)
+
+        branch[node] = dist[node] * scale
+        vt_width[node] = LINE_WIDTH if len(children) > 1 else 0.0
+        w4 = vt_width[node] if size[node] or faces_w[node] else 0.0
+        node_w[node] = max(branch[node], 0) + size[node] + wedge_w[node] + faces_w[node] + w4
+        node_h[node] = max(LINE_WIDTH, size[node], wedge_h[node], faces_h[node], 1) + BRANCH_VERTICAL_MARGIN
+        full_w[node] = node_w[node] + max([full_w[c] for c in children], default=0)
+        full_h[node] = max(node_h[node], sum(full_h[c] for c in children))
+
+    # positions, parents before their children (ete3's init_rect_node_item)
+    x = [0.0] * n
+    y = [0.0] * n
+    center = [0.0] * n
+    for node in range(n):
+        children = child_idx[child_ptr[node]:child_ptr[node + 1]]
+        sub_y = y[node]
+        children_h = sum(full_h[c] for c in children)
+        if node_h[node] > children_h:
+            sub_y += (full_h[node] - children_h) / 2
+        for c in children:
+            x[c] = x[node] + node_w[node]
+            y[c] = sub_y
+            sub_y += full_h[c]
+    for node in range(n - 1, -1, -1):
+        first = child_idx[child_ptr[node]] if child_ptr[node] < child_ptr[node + 1] else None
+        if first is None:
+            middle = full_h[node] / 2
+        else:
+            last = child_idx[child_ptr[node + 1] - 1]
+            middle = (y[first] + center[first] + y[last] + center[last]) / 2 - y[node]
+        half = node_h[node] / 2
+        if half > middle:
+            middle = half
+        elif half > full_h[node] - middle:
+            middle = full_h[node] - half
+        center[node] = middle
+
+    branches = []
+    balls = []
+    faces = []
+    for node in range(n):
+        cy = y[node] + center[node]
+        branches.append(f"M{_num(x[node])} {_num(cy)}H{_num(x[node] + branch[node])}")
+        children = child_idx[child_ptr[node]:child_ptr[node + 1]]
+        if children:
+            fx = x[node] + node_w[node] - vt_width[node] / 2
+            top = y[children[0]] + center[children[0]] - LINE_WIDTH / 2
+            bottom = y[children[-1]] + center[children[-1]] + LINE_WIDTH / 2
+            branches.append(f"M{_num(fx)} {_num(top)}V{_num(bottom)}")
+        face_x = x[node] + max(0, node_w[node] - faces_w[node] - vt_width[node])
+        if wedge_w[node]:
+            tip, top, bottom = face_x - wedge_w[node], cy - wedge_h[node] / 2, cy + wedge_h[node] / 2
+            balls.append(f'<polygon points="{_num(tip)},{_num(cy)} {_num(face_x)},{_num(top)} '
+                         f'{_num(face_x)},{_num(bottom)}" fill="{WEDGE_COLOR}" stroke="black"/>')
+        if size[node]:
+            balls.append((seqtype[node], SQUARE if square[node] else CIRCLE, face_x - size[node] / 2, cy,
+                          size[node], None))
+        column_x = face_x
+        for kind, value, width, height in face_columns[node]:
+            top = cy - faces_h[node] / 2 + (faces_h[node] - height) / 2
+            if kind == "name":
+                faces.append(_text(value, column_x, top, 10))
+            else:
+                faces.extend(_stack(value, column_x, top, height))
+            column_x += width
+
+    # frame around the tree, then the legend on top and the scale below
+    left, top, right, bottom = -MARGIN_LEFT, -MARGIN_TOP, full_w[0] + MARGIN_RIGHT, full_h[0] + MARGIN_BOTTOM
+    legend_items, legend_w, legend_h = _legend(legend, class_legend) if show_legend else ([], 0, 0)
+    right += max(0, legend_w - (right - left))
+    top -= legend_h
+    legend_x, legend_y = right - legend_w, top
+    scale_x, scale_y = left + MARGIN_LEFT, bottom
+    bottom += SCALE_LENGTH
+    scale_text = "%g" % (SCALE_LENGTH / scale if scale else 0.0)
+
+    width, height = right - left, bottom - top
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="800" height="{_num(800 * height / width)}" '
+        f'viewBox="{_num(left)} {_num(top)} {_num(width)} {_num(height)}" version="1.2" baseProfile="tiny">',
+        "<title>Generated with Koalafy</title>",
+        f'<rect id="background" x="{_num(left)}" y="{_num(top)}" width="{_num(width)}" height="{_num(height)}" '
+        'fill="white"/>',
+        f'<path id="branches" fill="none" stroke="black" stroke-width="{LINE_WIDTH}" d="{"".join(branches)}"/>',
+        '<g id="nodes">', *balls, "</g>",
+        '<g id="faces">', *faces, "</g>",
+        f'<g id="legend" transform="translate({_num(legend_x)},{_num(legend_y)})">', *legend_items, "</g>",
+        f'<g id="scale" transform="translate({_num(scale_x)},{_num(scale_y)})">',
+        f'<path fill="none" stroke="black" stroke-width="1" d="M0 5H{SCALE_LENGTH}M0 0V10M{SCALE_LENGTH} 0V10"/>',
+        _text(scale_text, 0, 10, 12),
+        "</g>",
+        "</svg>",
+    ]
+
+    # colored glyphs are placeholders until here, where their lines are known
+    colors = [color for label, color in legend]
+    lines = []
+    style_map = []
+    for item in out:
+        if isinstance(item, tuple):
+            style_map.append([len(lines), *item])
+            item = _glyph(item, colors, shapes)
+        lines.append(item)
+    return "\n".join(lines) + "\n", style_map
+
+
+def restyle_svg(svg, style_map, styles, drawn_styles=None):
+    """
+    This function returns the SVG written by render_svg() with the colored
+    glyphs of its style map drawn again for new styles, the (colors,
+    shapes) of every position in the legend. The tree and its layout are
+    left as they are. If the styles it was drawn with are given, only the
+    glyphs of the SeqTypes whose shape changed are drawn again, and the
+    ones whose color changed are only recolored.
+    """
+    colors, shapes = styles
+    redraw = None  # every glyph is drawn again
+    recolor = {}
+    if drawn_styles is not None:
+        redraw = set()
+        for k in range(-1, len(colors)):
+            color, shape = _look(k, *styles)
+            drawn_color, drawn_shape = _look(k, *drawn_styles)
+            if shape != drawn_shape:
+                redraw.add(k)
+            elif color != drawn_color:
+                recolor[k] = (drawn_color, color)
+    lines = svg.split("\n")
+    for line, *glyph in style_map:
+        seqtype = glyph[0]
+        if redraw is None or seqtype in redraw:
+            lines[line] = _glyph(glyph, colors, shapes)
+        elif seqtype in recolor:
+            drawn_color, color = recolor[seqtype]
+            text = lines[line].replace(f'fill="{_color(drawn_color)}"', f'fill="{_color(color)}"')
+            if glyph[-1] is None:  # outlined in its own color
+                text = text.replace(f'stroke="{_color(drawn_color)}"', f'stroke="{_color(color)}"')
+            lines[line] = text
+    return "\n".join(lines)
+
+
+def _look(seqtype, colors, shapes):
+    """
+    This function returns the color of a SeqType position and the shape
+    its circles are drawn as.
+    """
+    color = colors[seqtype] if 0 <= seqtype < len(colors) else "black"
+    return color, shapes.get(str(color).upper(), "circle").lower()
+
+
+def _stack_size(glyphs):
+    """
+    This function returns the width and height of a stack, laid out as
+    ete3_render.StackFace does.
+    """
+    width = 0
+    height = STACK_GLYPH_SIZE
+    for shape, seqtype, count in glyphs:
+        width += STACK_GLYPH_SIZE
+        if count > 1:
+            label_w, label_h, _ = text_size(f"×{count}", 8)
+            width += label_w + 6
+            height = max(height, label_h)
+    return width, height
+
+
+def _stack(glyphs, x, top, height):
+    """
+    This function returns the SVG elements of a stack drawn from x, top.
+    """
+    items = []
+    glyph_top = top + (height - STACK_GLYPH_SIZE) / 2
+    half = STACK_GLYPH_SIZE / 2
+    for shape, seqtype, count in glyphs:
+        # squares of a stack are outlined in white
+        items.append((seqtype, shape, x + half, glyph_top + half, STACK_GLYPH_SIZE,
+                      None if shape == CIRCLE else "white"))
+        x += STACK_GLYPH_SIZE
+        if count > 1:
+            label = f"×{count}"
+            label_w, label_h, _ = text_size(label, 8)
+            items.append(_text(label, x + 2, top + (height - label_h) / 2, 8))
+            x += label_w + 6
+    return items
+
+
+def _legend(legend, class_legend):
+    """
+    This function returns the SVG elements, width and height of the
+    legend, a grid of columns as built by tree-render-function.py.
+    """
+    padding = " " * 20
+    columns = [[("text", "", 20)], [("text", padding, 20)], [("text", "", 20)],
+               [("text", padding, 20)], [("text", "", 20)], [("text", padding, 20)]]
+    for k, (label, color) in enumerate(legend):
+        columns[1].append(("text", f" {label} " if label else " Undefined Sequence ", 12))
+        columns[0].append(("circle", k, 6))
+    if class_legend is not None:
+        alternate, default = class_legend
+        columns[3].append(("text", f" {alternate}", 12))
+        columns[2].append(("square", "black", 8))
+        columns[3].append(("text", f" {default}", 12))
+        columns[2].append(("circle", -1, 6))
+
+    def face_size(face):
+        kind, value, size = face
+        return text_size(value, size)[:2] if kind == "text" else (size, size)
+
+    column_w = [max(face_size(face)[0] for face in column) for column in columns]
+    row_h = [max(face_size(column[r])[1] for column in columns if r < len(column))
+             for r in range(max(len(column) for column in columns))]
+
+    items = []
+    x = 0
+    for column, width in zip(columns, column_w):
+        y = 0
+        for r, face in enumerate(column):
+            kind, value, size = face
+            face_h = face_size(face)[1]
+            face_y = y + (row_h[r] - face_h) / 2
+            if kind == "text":
+                if value.strip():
+                    items.append(_text(value, x, face_y, size))
+            elif kind == "circle":
+                items.append((value, CIRCLE, x + size / 2, face_y + size / 2, size, None))
+            else:
+                items.append(f'<rect x="{_num(x)}" y="{_num(face_y)}" width="{size}" height="{size}" '
+                             f'fill="white" stroke="{value}"/>')
+            y += row_h[r]
+        x += width
+    return items, sum(column_w), sum(row_h)
+
+
+def _glyph(glyph, colors, shapes):
+    """
+    This function returns a colored glyph (seqtype, shape, cx, cy, size,
+    outline) of the given size centered at cx, cy: a circle, or the shape
+    its color is mapped to in shapes, or a square. Its color is the one of
+    its SeqType in colors, or black, and it is outlined in that color
+    unless another outline is given.
+    """
+    seqtype, shape, cx, cy, size, outline = glyph
+    color = colors[seqtype] if seqtype >= 0 else "black"
+    shape = shapes.get(str(color).upper(), "circle") if shape == CIRCLE else None
+    # colors come from the parser table as typed, so they are escaped
+    color, outline = _color(color), _color(outline or color)
+    if shape is not None:
+        if shape.lower() == "circle":
+            return f'<circle cx="{_num(cx)}" cy="{_num(cy)}" r="{_num(size / 2)}" fill="{color}" stroke="{outline}"/>'
+        points = " ".join(f"{_num(px)},{_num(py)}" for px, py in shape_points(shape, cx, cy, size / 2))
+        return f'<polygon points="{points}" fill="{color}" stroke="{outline}"/>'
+    return (f'<rect x="{_num(cx - size / 2)}" y="{_num(cy - size / 2)}" width="{_num(size)}" height="{_num(size)}" '
+            f'fill="{color}" stroke="{outline}"/>')
+
+
+def _color(color):
+    """
+    This function returns a color escaped for an attribute value.
+    """
+    return escape(str(color), {'"': "&quot;"})
+
+
+def _text(text, x, top, size):
+    """
+    This function returns a text element written from x with its top at top.
+    """
+    baseline = top + text_size(text, size)[2]
+    return (f'<text x="{_num(x)}" y="{_num(baseline)}" font-family="{FONT}" font-size="{size}pt" '
+            f'xml:space="preserve">{escape(text)}</text>')
+
+
+def _num(value):
+    """
+    This function writes a coordinate with at most two decimals.
+    """
+    return f"{value:.2f}".rstrip("0").rstrip(".") if value != int(value) else str(int(value))
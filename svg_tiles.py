@@ -0,0 +1,186 @@
+"""
+svg_tiles.py
+    This python file contains the tiled viewer of the SVGs
+    written by svg_render.py. The drawing is cut into square
+    tiles of the tree's own coordinates, each holding the
+    elements (branches, nodes, faces, legend and scale) that
+    reach into it, gzip-compressed. A view of the tree only
+    opens the tiles it overlaps and writes their elements as
+    an SVG of its own, so the browser is sent and draws the
+    part of a large tree on screen and not all of it.
+    SVGs drawn by ete3 are not tiled.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import gzip
+import json
+import math
+import re
+from xml.sax.saxutils import unescape
+
+from svg_render import text_size, LINE_WIDTH
+
+TILE_SIZE = 1024  # width and height of a tile, in the SVG's own units
+
+# SVGs of up to this many elements are shown whole at first, larger ones a
+# view at a time, of this size (in the SVG's own units) at zoom 1
+WHOLE_TREE_ELEMENTS = 5000
+VIEW_WIDTH = 1200
+VIEW_HEIGHT = 1800
+
+_VIEWBOX = re.compile(r'viewBox="([-\d.]+) ([-\d.]+) ([-\d.]+) ([-\d.]+)"')
+_ATTRIBUTE = re.compile(r'([\w:-]+)="([^"]*)"')
+_TRANSLATE = re.compile(r"translate\(([-\d.]+),([-\d.]+)\)")
+_BRANCH = re.compile(r"M([-\d.]+) ([-\d.]+)([HV])([-\d.]+)")
+_PATH_STEP = re.compile(r"([MHV])([-\d.]+)(?: ([-\d.]+))?")
+_TEXT = re.compile(r">([^<]*)</text>")
+
+
+class SvgTiles:
+    """
+    This class holds an SVG of svg_render.py cut into tiles. Every
+    element is kept with its position in the SVG, so views draw them in
+    the same order, in every tile its bounding box reaches into.
+    """
+
+    def __init__(self, left, top, width, height, branch_style, branches, elements, tiles, tile_size=TILE_SIZE):
+        self.left = left  # the viewBox of the whole SVG
+        self.top = top
+        self.width = width
+        self.height = height
+        self.branch_style = branch_style  # the <path> of the branches, without its d
+        self.branches = branches  # the first elements are the branches
+        self.elements = elements
+        self.tiles = tiles  # gzip-compressed JSON [position, element] lists by (column, row)
+        self.tile_size = tile_size
+
+    @classmethod
+    def from_svg(cls, svg, tile_size=TILE_SIZE):
+        """
+        This function cuts an SVG written by svg_render.render_svg() (or
+        restyled by restyle_svg()) into tiles. It raises ValueError for
+        other SVGs.
+        """
+        lines = svg.splitlines()
+        found = _VIEWBOX.search(lines[0]) if lines else None
+        if found is None or len(lines) < 5 or not lines[3].startswith('<path id="branches"'):
+            raise ValueError("Only SVGs drawn by svg_render can be tiled")
+        left, top, width, height = (float(value) for value in found.groups())
+
+        # every branch is an element of its own, then the nodes and faces,
+        # and the legend and scale as one element each
+        elements = []
+        for step in _BRANCH.finditer(_attribute(lines[3], "d")):
+            x, y, kind, end = step.groups()
+            x, y, end = float(x), float(y), float(end)
+            box = (min(x, end), y, max(x, end), y) if kind == "H" else (x, min(y, end), x, max(y, end))
+            elements.append((step.group(0), box))
+        branches = len(elements)
+        i = 4
+        while i < len(lines):
+            if not lines[i].startswith("<g "):
+                i += 1
+                continue
+            end = lines.index("</g>", i)
+            children = lines[i + 1:end]
+            if lines[i].startswith('<g id="nodes"') or lines[i].startswith('<g id="faces"'):
+                elements.extend((child, _box(child)) for child in children)
+            else:
+                boxes = [box for box in map(_box, children) if box is not None]
+                translate = _TRANSLATE.search(lines[i])
+                dx, dy = (float(value) for value in translate.groups()) if translate else (0.0, 0.0)
+                if boxes:
+                    elements.append(("\n".join(lines[i:end + 1]),
+                                     (min(b[0] for b in boxes) + dx, min(b[1] for b in boxes) + dy,
+                                      max(b[2] for b in boxes) + dx, max(b[3] for b in boxes) + dy)))
+            i = end + 1
+
+        # boxes are widened by the stroke drawn around them
+        tiles = {}
+        for position, (element, box) in enumerate(elements):
+            if box is None:
+                continue
+            box_left, box_top, box_right, box_bottom = (box[0] - LINE_WIDTH, box[1] - LINE_WIDTH,
+                                                        box[2] + LINE_WIDTH, box[3] + LINE_WIDTH)
+            for column in range(_tile(box_left, left, tile_size), _tile(box_right, left, tile_size) + 1):
+                for row in range(_tile(box_top, top, tile_size), _tile(box_bottom, top, tile_size) + 1):
+                    tiles.setdefault((column, row), []).append([position, element])
+        tiles = {key: gzip.compress(json.dumps(tile).encode()) for key, tile in tiles.items()}
+        branch_style = re.sub(r' d="[^"]*"', "", lines[3])
+        return cls(left, top, width, height, branch_style, branches, len(elements), tiles, tile_size)
+
+    def view(self, x, y, width, height, pixels=800):
+        """
+        This function returns the region of the tree from x, y of the
+        given width and height (in the SVG's own units) as an SVG that is
+        pixels wide, drawn from the elements of the tiles it overlaps.
+        """
+        found = {}
+        for column in range(_tile(x, self.left, self.tile_size), _tile(x + width, self.left, self.tile_size) + 1):
+            for row in range(_tile(y, self.top, self.tile_size), _tile(y + height, self.top, self.tile_size) + 1):
+                if (column, row) in self.tiles:
+                    found.update(json.loads(gzip.decompress(self.tiles[(column, row)])))
+        positions = sorted(found)
+        branches = "".join(found[p] for p in positions if p < self.branches)
+        out = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{pixels}" height="{pixels * height / width:g}" '
+            f'viewBox="{x:g} {y:g} {width:g} {height:g}" version="1.2" baseProfile="tiny">',
+            f'<rect x="{x:g}" y="{y:g}" width="{width:g}" height="{height:g}" fill="white"/>',
+        ]
+        if branches:
+            out.append(self.branch_style.replace("/>", f' d="{branches}"/>'))
+        out.extend(found[p] for p in positions if p >= self.branches)
+        out.append("</svg>")
+        return "\n".join(out) + "\n"
+
+
+def _tile(coordinate, origin, tile_size):
+    """
+    This function returns the column (or row) of the tiles a coordinate
+    falls in.
+    """
+    return math.floor((coordinate - origin) / tile_size)
+
+
+def _attribute(element, name):
+    """
+    This function returns the value of an attribute of an element.
+    """
+    found = re.search(r' %s="([^"]*)"' % name, element)
+    return found.group(1) if found else ""
+
+
+def _box(element):
+    """
+    This function returns the bounding box (left, top, right, bottom) of
+    a single-line element written by svg_render.py, or None.
+    """
+    attributes = dict(_ATTRIBUTE.findall(element.split(">", 1)[0]))
+    if element.startswith("<circle"):
+        cx, cy, r = float(attributes["cx"]), float(attributes["cy"]), float(attributes["r"])
+        return cx - r, cy - r, cx + r, cy + r
+    if element.startswith("<rect"):
+        x, y = float(attributes["x"]), float(attributes["y"])
+        return x, y, x + float(attributes["width"]), y + float(attributes["height"])
+    if element.startswith("<polygon"):
+        points = [float(value) for value in re.split(r"[ ,]", attributes["points"])]
+        return min(points[0::2]), min(points[1::2]), max(points[0::2]), max(points[1::2])
+    if element.startswith("<text"):
+        size = int(attributes["font-size"].rstrip("pt"))
+        text_w, text_h, baseline = text_size(unescape(_TEXT.search(element).group(1)), size)
+        x, top = float(attributes["x"]), float(attributes["y"]) - baseline
+        return x, top, x + text_w, top + text_h
+    if element.startswith("<path"):
+        xs, ys = [], []
+        x = y = 0.0
+        for kind, first, second in _PATH_STEP.findall(attributes["d"]):
+            if kind == "M":
+                x, y = float(first), float(second)
+            elif kind == "H":
+                x = float(first)
+            else:
+                y = float(first)
+            xs.append(x)
+            ys.append(y)
+        return (min(xs), min(ys), max(xs), max(ys)) if xs else None
+    return None
@@ -0,0 +1,74 @@
+"""
+conftest.py
+    This python file sets up the tests: it makes the modules of
+    the app importable and builds the seeded random trees the
+    array rewrite is checked against ete3 with.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# seeds of the random trees every comparison is run on, with branch
+# lengths of any size or only 0.1, 0.2 and 0.3, whose sums are where the
+# order branch lengths are added in changes the distance
+TREE_SEEDS = range(8)
+DECIMAL_SEEDS = range(4)
+# small trees whose midpoint falls exactly on a node or whose branches
+# are all zero, ties no random tree reaches
+EDGE_TREES = ["((A:1,B:1):1,(C:1,D:1):1);", "((A:1,B:1):0,(C:1,(D:1,E:1):0):1);", "(A:1,B:1,(C:1,D:1):0);",
+              "((A:0,B:0):0,(C:0,D:0):0);", "(A:1,(B:0.5,(C:0.25,D:0.25):0.25):0.5,E:1);"]
+# thresholds the clones are searched at, including ones met exactly by
+# zero-length branches, by the short branches below and by sums of the
+# decimal ones
+THRESHOLDS = [0.0, 1e-6, 2e-6, 1e-3, 0.01, 0.05, 0.3, 0.6]
+
+
+def random_newick(seed, leaves=60, decimal=False):
+    """
+    This function returns a random Newick tree with polytomies,
+    zero-length and very short branches and duplicate leaf names, the
+    cases where the array rewrite could drift from ete3. With decimal,
+    every branch is 0.1, 0.2 or 0.3 long instead.
+    """
+    rng = random.Random(seed)
+    branch_length = decimal_length if decimal else any_length
+    names = [f"P{rng.randrange(4)}_{rng.choice(['AA', 'BB', 'CC'])}_{i}" for i in range(leaves)]
+    for i in rng.sample(range(leaves), leaves // 10):
+        names[i] = names[rng.randrange(leaves)]  # duplicate names
+    nodes = [name + f":{branch_length(rng)}" for name in names]
+    while len(nodes) > 1:
+        # join two to four clades, polytomies are common in real trees
+        size = min(len(nodes), rng.choice([2, 2, 2, 3, 4]))
+        joined = [nodes.pop(rng.randrange(len(nodes))) for _ in range(size)]
+        nodes.append(f"({','.join(joined)}):{branch_length(rng)}")
+    return nodes[0].rsplit(":", 1)[0] + ";"
+
+
+def any_length(rng):
+    """
+    This function returns a random branch length, often zero or as long
+    as a single mutation.
+    """
+    return rng.choice([0, 0, 1e-6, 2e-6, round(rng.uniform(0, 0.02), 6), round(rng.uniform(0, 0.3), 4)])
+
+
+def decimal_length(rng):
+    """
+    This function returns a branch length of 0.1, 0.2 or 0.3.
+    """
+    return rng.choice([0.1, 0.2, 0.3])
+
+
+@pytest.fixture(params=[("random", seed) for seed in TREE_SEEDS] + [("decimal", seed) for seed in DECIMAL_SEEDS]
+                + [("edge", tree) for tree in EDGE_TREES])
+def newick(request):
+    kind, value = request.param
+    if kind == "edge":
+        return value
+    return random_newick(value, decimal=kind == "decimal")
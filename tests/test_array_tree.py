@@ -0,0 +1,71 @@
+"""
+test_array_tree.py
+    This python file checks that rooting, ladderizing and
+    collapsing an ArrayTree give the tree ete3 gives, node for
+    node, on seeded random trees.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import random
+
+import pytest
+from ete3 import Tree
+
+from array_tree import prepare_tree
+from newick_reader import read_tree
+
+
+def ete_nodes(t):
+    """
+    This function returns every node of an ete3 tree in preorder as
+    (name, branch length, support, number of children).
+    """
+    return [(node.name, node.dist, node.support, len(node.children)) for node in t.traverse("preorder")]
+
+
+def array_nodes(t):
+    """
+    This function returns every node of an ArrayTree in preorder, as
+    ete_nodes() does.
+    """
+    children = t.children_lists()
+    return [(t.names[t.name_id[i]], float(t.dist[i]), float(t.support[i]), len(children[i])) for i in range(len(t))]
+
+
+def ete_prepared(newick, rooting_node):
+    """
+    This function roots and ladderizes a tree with ete3, the way
+    render_tree always has.
+    """
+    t = Tree(newick)
+    if rooting_node == "midpoint" or not t.search_nodes(name=rooting_node):
+        t.set_outgroup(t.get_midpoint_outgroup())
+    else:
+        t.set_outgroup(rooting_node)
+    t.ladderize()
+    return t
+
+
+@pytest.mark.parametrize("rooting", ["midpoint", "leaf", "missing"])
+def test_rooting_and_ladderizing_match_ete3(newick, rooting):
+    if rooting == "leaf":
+        names = [leaf.name for leaf in Tree(newick).iter_leaves()]
+        rooting_node = next(name for name in reversed(names) if names.count(name) == 1)
+    else:
+        rooting_node = "midpoint" if rooting == "midpoint" else "not in the tree"
+    expected = ete_prepared(newick, rooting_node)
+    t = prepare_tree(read_tree(newick.encode()), rooting_node)
+    assert array_nodes(t) == ete_nodes(expected)
+
+
+def test_collapse_matches_ete3_prune(newick):
+    expected = ete_prepared(newick, "midpoint")
+    t = prepare_tree(read_tree(newick.encode()), "midpoint")
+    rng = random.Random(newick)
+    for size in (1, 2, len(t.leaves) // 3, len(t.leaves) - 1):
+        keep = sorted(rng.sample(range(len(t.leaves)), size))
+        pruned = expected.copy()
+        leaves = list(pruned.iter_leaves())
+        pruned.prune([leaves[k] for k in keep], preserve_branch_length=True)
+        collapsed, _ = t.collapse(t.leaves[keep])
+        assert array_nodes(collapsed) == ete_nodes(pruned)
@@ -0,0 +1,71 @@
+"""
+test_clone_detection.py
+    This python file checks that the clone search on the array
+    tree gives the clones the greedy pass over ete3's
+    get_distance() gives, at every threshold, and that the
+    parallel search gives the same clones as the single
+    process one.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import clone_detection
+from array_tree import prepare_tree
+from clone_detection import clone_merge_table, clone_groups_at, find_clone_groups
+from conftest import THRESHOLDS, random_newick
+from newick_reader import read_tree
+from test_array_tree import ete_prepared
+
+
+def ete_clone_groups(t, thresholds):
+    """
+    This function runs the greedy pass render_tree has always run on an
+    ete3 tree, and returns the leading leaf of every leaf per threshold.
+    """
+    leaves = list(t.iter_leaves())
+    distance = [[t.get_distance(leaf, other) for other in leaves] for leaf in leaves]
+    columns = []
+    for threshold in thresholds:
+        leader_of = [-1] * len(leaves)
+        for i in range(len(leaves)):
+            if leader_of[i] != -1:
+                continue
+            leader_of[i] = i
+            for j in range(len(leaves)):
+                if leader_of[j] == -1 and distance[i][j] <= threshold:
+                    leader_of[j] = i
+        columns.append(leader_of)
+    return columns
+
+
+def test_clone_merge_table_matches_ete3(newick):
+    expected = ete_prepared(newick, "midpoint")
+    t = prepare_tree(read_tree(newick.encode()), "midpoint")
+    table = clone_merge_table(t, THRESHOLDS)
+    assert table["leaf"].to_list() == [leaf.name for leaf in expected.iter_leaves()]
+    for threshold, leader_of in zip(THRESHOLDS, ete_clone_groups(expected, THRESHOLDS)):
+        assert clone_groups_at(table, threshold) == leader_of
+        assert find_clone_groups(t, threshold) == leader_of
+
+
+@pytest.mark.parametrize("method", [method for method in ("fork", "forkserver", "spawn")
+                                    if method in multiprocessing.get_all_start_methods()])
+def test_parallel_search_matches_single_process(monkeypatch, method):
+    monkeypatch.setattr(clone_detection, "PARALLEL_MIN_LEAVES", 100)
+    monkeypatch.setattr(clone_detection, "available_cpus", lambda: 2)
+    monkeypatch.setattr(clone_detection, "START_METHOD", method)
+    t = prepare_tree(read_tree(random_newick(0, leaves=400).encode()), "midpoint")
+    workers = clone_detection.clone_workers(t)
+    assert workers == 2
+    # only branches longer than every threshold split the tree into clades
+    thresholds = [threshold for threshold in THRESHOLDS if threshold < 0.1]
+    search = clone_detection._CloneSearch(t)
+    assert clone_detection._parallel_clone_pass(search, thresholds, workers) is not None
+    parallel = clone_merge_table(t, thresholds, workers)
+    single = clone_merge_table(t, thresholds)
+    assert parallel.equals(single)
+    assert np.array_equal(parallel["merge_height"], single["merge_height"], equal_nan=True)
@@ -0,0 +1,96 @@
+"""
+tree_export.py
+    This python file converts the rendered tree (the SVG made by
+    the render engine) to a PDF or PNG. The tree is only drawn
+    once, as an SVG, and the other formats are made from it
+    when they are asked for on the Homepage, so they also get
+    the custom node shapes.
+    The Homepage calls export_bytes() in the render pool, and
+    render_engine.render() calls it for the PDF and PNG outputs
+    of tree-render-function.py, as Qt has to run in the main
+    thread of its process. PyQt5 is only imported when a tree
+    is exported, so the Homepage can read the export settings
+    without loading it.
+    For more information see:
+    https://github.com/walkerazam/cohn-treemaker
+"""
+import os
+import sys
+os.environ['QT_QPA_PLATFORM']='offscreen'
+
+# formats the SVG can be exported to, with their mime types
+EXPORT_FORMATS = {"pdf": "application/pdf", "png": "image/png"}
+
+# same size as the tree was rendered at before (w=4, dpi=200, units='in')
+EXPORT_WIDTH_IN = 4
+EXPORT_DPI = 200
+
+
+def export_tree(svg_file, out_file, dpi=EXPORT_DPI, width_in=EXPORT_WIDTH_IN):
+    """
+    This function draws svg_file into out_file, a PDF or PNG (picked by
+    its extension) width_in inches wide. PNGs are drawn at dpi dots per
+    inch on a white background.
+    """
+    with open(svg_file, "rb") as file:
+        svg = file.read()
+    try:
+        data = export_bytes(svg, os.path.splitext(out_file)[1].lower().lstrip("."), dpi, width_in)
+    except ValueError as e:
+        raise ValueError(f"{e} ({svg_file})")
+    with open(out_file, "wb") as file:
+        file.write(data)
+
+
+def export_bytes(svg, export_format, dpi=EXPORT_DPI, width_in=EXPORT_WIDTH_IN):
+    """
+    This function draws an SVG (text or bytes) as a PDF or PNG
+    (export_format) width_in inches wide, as export_tree() does, and
+    returns its bytes.
+    """
+    from PyQt5.QtCore import QRectF, QSizeF, QMarginsF, Qt, QBuffer, QByteArray, QIODevice
+    from PyQt5.QtGui import QGuiApplication, QImage, QPainter, QPageSize, QPageLayout, QColor, QPdfWriter
+    from PyQt5.QtSvg import QSvgRenderer
+
+    app = QGuiApplication.instance() or QGuiApplication(sys.argv[:1])  # kept until drawn
+    renderer = QSvgRenderer(QByteArray(svg.encode() if isinstance(svg, str) else svg))
+    if not renderer.isValid():
+        raise ValueError("Could not read the SVG")
+    box = renderer.viewBoxF()
+    height_in = width_in * box.height() / box.width()
+
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    if export_format == "png":
+        image = QImage(round(width_in * dpi), round(height_in * dpi), QImage.Format_ARGB32)
+        image.fill(QColor(Qt.white))
+        image.setDotsPerMeterX(round(dpi / 0.0254))
+        image.setDotsPerMeterY(round(dpi / 0.0254))
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing)
+        renderer.render(painter, QRectF(0, 0, image.width(), image.height()))
+        painter.end()
+        if not image.save(buffer, "PNG"):
+            raise ValueError("Could not write the PNG")
+    elif export_format == "pdf":
+        writer = QPdfWriter(buffer)
+        writer.setResolution(1200)
+        writer.setPageLayout(QPageLayout(QPageSize(QSizeF(width_in, height_in), QPageSize.Inch),
+                                         QPageLayout.Portrait, QMarginsF(0, 0, 0, 0)))
+        painter = QPainter(writer)
+        renderer.render(painter, QRectF(painter.viewport()))
+        painter.end()
+    else:
+        raise ValueError(f"Unsupported export format: {export_format}")
+    buffer.close()
+    return bytes(buffer.data())
+
+
+if __name__ == "__main__":
+    # Get the file paths (and PNG resolution) from the subprocess command-line arguments
+    if len(sys.argv) > 3:
+        export_tree(sys.argv[1], sys.argv[2], int(sys.argv[3]))
+    elif len(sys.argv) > 2:
+        export_tree(sys.argv[1], sys.argv[2])
+    else:
+        print("Error: No file provided.")